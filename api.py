@@ -4,19 +4,40 @@ This can also contain game logic. For more complex games it would be wise to
 move game logic to another file. Ideally the API will be simple, concerned
 primarily with communication to/from the API's users."""
 
-import logging
+import time
+_import_started = time.time()
+
 import endpoints
 from protorpc import remote, messages
-from google.appengine.api import memcache
-from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
 
 from models import (
-    User, Game, Score,
-    NewGameForm, GameForm, GameForms, GameHistoryForm,
-    MakeMoveForm, ScoreForms, UserForms,
+    User, Game, Score, scores_to_forms_async, games_to_forms_async,
+    NewGameForm, GameForm, GameForms, GameHistoryForm, MoveForms,
+    MakeMoveForm, MakeMovesForm, MoveResultForm, MoveResultForms,
+    ScoreForm, ScoreForms, UserForm, UserForms, RankForm, HintForm,
+    UserStatsForm,
     StringMessage
 )
-from utils import get_by_urlsafe
+from utils import (
+    get_by_urlsafe, get_key_by_urlsafe, fetch_page, fetch_page_async,
+    offset_page_token, rpc_budget
+)
+import archive
+import counters
+import formcache
+import leaderboard
+import metrics
+import ratelimit
+import solver
+import stats
+import userdir
+
+# A finishing move is begin, get Game, get User and stats, put all, commit.
+MAKE_MOVE_RPC_BUDGET = 5
+MAKE_MOVE_RETRIES = 3
+# Only 26 guesses can be accepted in any game.
+MAX_MOVES_PER_REQUEST = 26
 
 NEW_GAME_REQUEST = endpoints.ResourceContainer(NewGameForm)
 GET_GAME_REQUEST = endpoints.ResourceContainer(
@@ -26,10 +47,23 @@ MAKE_MOVE_REQUEST = endpoints.ResourceContainer(
     urlsafe_game_key=messages.StringField(1),)
 USER_REQUEST = endpoints.ResourceContainer(user_name=messages.StringField(1),
                                            email=messages.StringField(2))
+MAKE_MOVES_REQUEST = endpoints.ResourceContainer(
+    MakeMovesForm,
+    urlsafe_game_key=messages.StringField(1),)
+GAME_MOVES_REQUEST = endpoints.ResourceContainer(
+    urlsafe_game_key=messages.StringField(1),
+    offset=messages.IntegerField(2),
+    limit=messages.IntegerField(3),)
+USER_PAGE_REQUEST = endpoints.ResourceContainer(
+    user_name=messages.StringField(1),
+    page_size=messages.IntegerField(2),
+    page_token=messages.StringField(3),)
+PAGE_REQUEST = endpoints.ResourceContainer(
+    page_size=messages.IntegerField(1),
+    page_token=messages.StringField(2),)
 NUMBER_RESULTS_REQUEST = endpoints.ResourceContainer(
-    num_results=messages.IntegerField(1),)
-
-MEMCACHE_STRIKES_REMAINING = 'STRIKES_REMAINING'
+    num_results=messages.IntegerField(1),
+    page_token=messages.StringField(2),)
 
 
 @endpoints.api(name='hangman', version='v1')
@@ -40,13 +74,15 @@ class HangmanApi(remote.Service):
                       path='user',
                       name='create_user',
                       http_method='POST')
+    @metrics.instrumented()
+    @ratelimit.limited('create_user', ratelimit.by_client)
     def create_user(self, request):
         """Create a User. Requires a unique username"""
-        if User.query(User.name == request.user_name).get():
+        user = userdir.create_user(request.user_name, request.email)
+        if not user:
             raise endpoints.ConflictException(
                 'A User with that name already exists!')
-        user = User(name=request.user_name, email=request.email)
-        user.put()
+        leaderboard.record_user(user)
         return StringMessage(message='User {} created!'.format(
             request.user_name))
 
@@ -55,18 +91,24 @@ class HangmanApi(remote.Service):
                       path='game',
                       name='new_game',
                       http_method='POST')
+    @metrics.instrumented()
+    @ratelimit.limited('new_game', ratelimit.by_field('user_name'))
     def new_game(self, request):
         """Creates new game"""
-        user = User.query(User.name == request.user_name).get()
-        if not user:
+        user_key = userdir.get_user_key(request.user_name)
+        if not user_key:
             raise endpoints.NotFoundException(
                 'A User with that name does not exist!')
-        game = Game.new_game(user.key)
-        game.put()
-        # Use a task queue to update the average strikes remaining.
+        try:
+            game = Game.new_game(user_key, request.user_name, request.pack,
+                                 request.word_length, request.difficulty)
+        except ValueError as e:
+            raise endpoints.BadRequestException(str(e))
+        counters.increment(games=1, strikes=game.strikes_remaining)
+        # Use a task queue to correct any drift in the active game counters.
         # This operation is not needed to complete the creation of a new game
-        # so it is performed out of sequence.
-        taskqueue.add(url='/tasks/cache_average_strikes')
+        # so it is performed out of sequence, at most once per time window.
+        counters.schedule_reconcile()
         return game.to_form('Good luck playing Hangman!')
 
     @endpoints.method(request_message=GET_GAME_REQUEST,
@@ -74,147 +116,281 @@ class HangmanApi(remote.Service):
                       path='game/{urlsafe_game_key}',
                       name='get_game',
                       http_method='GET')
+    @metrics.instrumented()
     def get_game(self, request):
-        """Return the current game state."""
-        game = get_by_urlsafe(request.urlsafe_game_key, Game)
-        if game:
-            if game.game_over:
-                return game.to_form('This game is over!')
-            return game.to_form('Time to guess a letter!')
+        """Return the current game state. Served from the response cache
+        while the game is unchanged; a client sending the etag of its last
+        response in an If-None-Match header gets only the etag and
+        not_modified instead."""
+        return formcache.get_form(
+            GameForm, 'get_game', request.urlsafe_game_key,
+            self._if_none_match(),
+            lambda: HangmanApi._get_game_async(
+                request.urlsafe_game_key).get_result())
+
+    def _if_none_match(self):
+        """Returns the request's If-None-Match header, if any"""
+        state = self.request_state
+        return state.headers.get('If-None-Match') if state else None
+
+    @staticmethod
+    @ndb.tasklet
+    def _get_game_async(urlsafe_game_key):
+        """Tasklet resolving the GameForm for get_game and the version of
+        the game it was built from"""
+        game_key = get_key_by_urlsafe(urlsafe_game_key, Game)
+        game = yield game_key.get_async()
+        if not game:
+            raise endpoints.NotFoundException('Game not found!')
+        user_name = yield game.get_user_name_async()
+        if game.game_over:
+            form = game.to_form('This game is over!', user_name)
         else:
+            form = game.to_form('Time to guess a letter!', user_name)
+        raise ndb.Return((form, game.version))
+
+    @endpoints.method(request_message=GET_GAME_REQUEST,
+                      response_message=HintForm,
+                      path='game/{urlsafe_game_key}/hint',
+                      name='get_hint',
+                      http_method='GET')
+    @metrics.instrumented()
+    @ratelimit.limited('get_hint', ratelimit.by_field('urlsafe_game_key'))
+    def get_hint(self, request):
+        """Suggests the unguessed letter found in the most words that could
+        still be the answer. Only what the player can see (the shown string
+        and the letters guessed) is used."""
+        game = get_by_urlsafe(request.urlsafe_game_key, Game)
+        if not game:
             raise endpoints.NotFoundException('Game not found!')
+        if game.game_over:
+            raise endpoints.ForbiddenException('Illegal action: Game is '
+                                               'already over.')
+        shown = game.shown_string
+        index = solver.get_index(game.pack, len(shown))
+        letter, candidates, hits = solver.hint(index, shown,
+                                               game.letter_mask)
+        if letter:
+            message = '{} of {} possible words contain {}'.format(
+                hits, candidates, letter)
+        else:
+            message = 'No word in the list fits, so no hint can be given!'
+        return HintForm(urlsafe_key=game.key.urlsafe(), letter=letter,
+                        candidates=candidates, hits=hits, message=message)
 
     @endpoints.method(request_message=MAKE_MOVE_REQUEST,
                       response_message=GameForm,
                       path='game/{urlsafe_game_key}',
                       name='make_move',
                       http_method='PUT')
+    @metrics.instrumented()
+    @ratelimit.limited('make_move', ratelimit.by_field('urlsafe_game_key'))
     def make_move(self, request):
         """Makes a move. Returns a game state with message"""
-        game = get_by_urlsafe(request.urlsafe_game_key, Game)
-        theUser = User.query(User.key == game.user).get()
+        game_key = get_key_by_urlsafe(request.urlsafe_game_key, Game)
+        game, results = HangmanApi._make_moves(game_key, [request.guess])
+        return game.to_form(results[0][1])
+
+    @endpoints.method(request_message=MAKE_MOVES_REQUEST,
+                      response_message=MoveResultForms,
+                      path='game/{urlsafe_game_key}/moves',
+                      name='make_moves',
+                      http_method='PUT')
+    @metrics.instrumented()
+    @ratelimit.limited('make_moves', ratelimit.by_field('urlsafe_game_key'))
+    def make_moves(self, request):
+        """Makes an ordered list of moves with the same rules as make_move,
+        stopping if the game ends. Returns the result of each guess played
+        and the final game state"""
+        if not request.guesses:
+            raise endpoints.BadRequestException('No guesses given!')
+        if len(request.guesses) > MAX_MOVES_PER_REQUEST:
+            raise endpoints.BadRequestException(
+                'At most {} guesses may be made at once'.format(
+                    MAX_MOVES_PER_REQUEST))
+        game_key = get_key_by_urlsafe(request.urlsafe_game_key, Game)
+        game, results = HangmanApi._make_moves(game_key, request.guesses)
+        return MoveResultForms(
+            results=[MoveResultForm(guess=guess, message=msg,
+                                    accepted=strikes_lost is not None)
+                     for guess, msg, strikes_lost in results],
+            game=game.to_form(results[-1][1]))
+
+    @staticmethod
+    def _make_moves(game_key, guesses):
+        """Plays guesses in a single transaction, then updates the active
+        game counters and leaderboard. Returns the game and the list of
+        (guess, message, strikes_lost) results from _play_moves"""
+        game, results, user, previous_band, score = \
+            HangmanApi._play_moves(game_key, guesses)
+        strikes_lost = sum(r[2] for r in results if r[2])
+        if score:
+            game.record_end(score, strikes_lost)
+            leaderboard.record_user(user, previous_band)
+        elif strikes_lost:
+            counters.increment(strikes=-strikes_lost)
+        return game, results
+
+    @staticmethod
+    @ndb.transactional(xg=True, retries=MAKE_MOVE_RETRIES)
+    def _play_moves(game_key, guesses):
+        """Plays guesses in order in a cross-group transaction, so concurrent
+        guesses on the same game can't lose updates. Returns what
+        _play_guesses returns."""
+        # The budget is checked on each attempt, before it commits, so a
+        # retry after contention doesn't count against it and going over
+        # budget never fails a move that has already been saved. The commit
+        # itself comes after the block, hence one RPC less.
+        with rpc_budget('make_move', MAKE_MOVE_RPC_BUDGET - 1):
+            return HangmanApi._play_guesses(game_key, guesses)
+
+    @staticmethod
+    def _play_guesses(game_key, guesses):
+        """Plays guesses in order; must be called in a transaction. Guesses
+        after the one that ends the game are not played. The User is only
+        read when the game ends, and a finishing move writes the Game, its
+        Score, the User and their stats in one batch. Returns a (game,
+        results, user, previous_band, score) tuple, where results holds a
+        (guess, message, strikes_lost) tuple per guess played (strikes_lost
+        is None if it was rejected); user, previous_band and score are None
+        unless the game ended."""
+        game = game_key.get()
+        if not game:
+            raise endpoints.NotFoundException('Game not found!')
         # Test if the game is already over.
         if game.game_over:
             raise endpoints.ForbiddenException('Illegal action: '
                                                'Game is already over.')
 
-        if len(request.guess) > 1 or request.guess.isalpha() is False:
-            return game.to_form('Your guess must be a single English letter!')
-
-        if request.guess in game.guessed_letters:
-            return game.to_form('You have already guessed this letter')
-
-        if request.guess in game.target_string:
-            game.guessed_letters += request.guess
-            game.correct_letters += request.guess
-            msg = "The letter IS in the secret word!"
-            game.history.append(
-                {"guess": request.guess, "message": msg,
-                 "strikes": game.strikes_remaining})
-        else:
-            game.strikes_remaining -= 1
-            game.guessed_letters += request.guess
-            msg = "The letter IS NOT in the secret word!"
-            game.history.append(
-                {"guess": request.guess, "message": msg,
-                 "strikes": game.strikes_remaining})
-
-        for i in range(len(game.target_string)):
-            if game.target_string[i] in game.correct_letters:
-                game.shown_string = game.shown_string[
-                    :i] + game.target_string[i] + game.shown_string[i + 1:]
-
-        if game.shown_string == game.target_string:
-            game.end_game(True)
-            theUser.games_played += 1
-            theUser.career_points += game.strikes_remaining
-            # theUser.performance is updated upon theUser.put()
-            theUser.put()
-            return game.to_form('You win! ')
-
-        if game.strikes_remaining < 1:
-            game.end_game(False)
-            theUser.games_played += 1
-            theUser.career_points += game.strikes_remaining
-            # theUser.performance is updated upon theUser.put()
-            theUser.put()
-            return game.to_form(msg + ' Game over!')
-        else:
+        results = []
+        for guess in guesses:
+            msg, strikes_lost = game.play_guess(guess)
+            results.append((guess, msg, strikes_lost))
+            if game.game_over:
+                break
+        if all(r[2] is None for r in results):
+            return game, results, None, None, None
+        if not game.game_over:
             game.put()
-            return game.to_form(msg)
+            return game, results, None, None, None
 
-    @endpoints.method(response_message=ScoreForms,
+        user, user_stats = ndb.get_multi(
+            [game.user, stats.UserStats.key_for(game.user)])
+        user_stats = user_stats or stats.UserStats.empty(game.user)
+        previous_band = leaderboard.band_for(user)
+        score = game.finish(game.is_solved())
+        user.add_game(game.strikes_remaining)
+        user_stats.add_score(score)
+        ndb.put_multi([game, score, user, user_stats])
+        return game, results, user, previous_band, score
+
+    @endpoints.method(request_message=PAGE_REQUEST,
+                      response_message=ScoreForms,
                       path='scores',
                       name='get_scores',
                       http_method='GET')
+    @metrics.instrumented()
+    @ratelimit.limited('get_scores', ratelimit.by_client)
     def get_scores(self, request):
-        """Return all scores"""
-        return ScoreForms(items=[score.to_form() for score in Score.query()])
+        """Return all scores, one page at a time"""
+        return HangmanApi._get_scores_async(
+            Score.query(), request.page_size,
+            request.page_token).get_result()
 
-    @endpoints.method(request_message=USER_REQUEST,
+    @staticmethod
+    @ndb.tasklet
+    def _get_scores_async(query, page_size, page_token):
+        """Tasklet resolving the ScoreForms for one page of a Score query"""
+        scores, token = yield fetch_page_async(query, page_size, page_token)
+        forms = yield scores_to_forms_async(scores)
+        raise ndb.Return(ScoreForms(items=forms, next_page_token=token))
+
+    @endpoints.method(request_message=USER_PAGE_REQUEST,
                       response_message=ScoreForms,
                       path='scores/user/{user_name}',
                       name='get_user_scores',
                       http_method='GET')
+    @metrics.instrumented()
+    @ratelimit.limited('get_user_scores', ratelimit.by_field('user_name'))
     def get_user_scores(self, request):
-        """Returns all of an individual User's scores"""
-        user = User.query(User.name == request.user_name).get()
-        if not user:
+        """Returns all of an individual User's scores, one page at a time"""
+        user_key = userdir.get_user_key(request.user_name)
+        if not user_key:
+            raise endpoints.NotFoundException(
+                'A User with that name does not exist!')
+        return HangmanApi._get_scores_async(
+            Score.query(Score.user == user_key), request.page_size,
+            request.page_token).get_result()
+
+    @endpoints.method(request_message=USER_REQUEST,
+                      response_message=UserStatsForm,
+                      path='stats/user/{user_name}',
+                      name='get_user_stats',
+                      http_method='GET')
+    @metrics.instrumented()
+    @ratelimit.limited('get_user_stats', ratelimit.by_field('user_name'))
+    def get_user_stats(self, request):
+        """Returns an individual User's statistics (wins, losses, streaks,
+        points histogram and last played date) from their rollup"""
+        user_key = userdir.get_user_key(request.user_name)
+        if not user_key:
             raise endpoints.NotFoundException(
                 'A User with that name does not exist!')
-        scores = Score.query(Score.user == user.key)
-        return ScoreForms(items=[score.to_form() for score in scores])
+        user_stats = stats.get_stats_async(user_key).get_result()
+        return user_stats.to_form(request.user_name)
 
     @endpoints.method(response_message=StringMessage,
                       path='games/average_strikes',
                       name='get_average_strikes_remaining',
                       http_method='GET')
+    @metrics.instrumented()
     def get_average_strikes(self, request):
-        """Get the cached average moves remaining"""
-        return StringMessage(message=memcache.
-                             get(MEMCACHE_STRIKES_REMAINING) or '')
+        """Get the average strikes remaining from the active game counters"""
+        count, total_strikes_remaining = counters.get_totals()
+        if count < 1:
+            return StringMessage(message='')
+        average = float(total_strikes_remaining) / count
+        return StringMessage(message='The average strikes remaining is '
+                             '{:.2f}'.format(average))
 
-    @staticmethod
-    def _cache_average_strikes():
-        """Populates memcache with the average moves remaining of Games"""
-        logging.info('Going to cache the average strikes')
-        games = Game.query(Game.game_over == False).fetch()
-        # this isn't working if I do (not Game.game_over)
-        # or (Game.game_over is False) it is frustrating.
-        # anaconda plugin keeps yelling at me that this is against PEP 8
-        logging.info('I made it this far')
-        if games:
-            logging.info('This is the len of games: ' + str(len(games)))
-            count = len(games)
-            total_strikes_remaining = sum([game.strikes_remaining
-                                           for game in games])
-            average = float(total_strikes_remaining) / count
-            memcache.set(MEMCACHE_STRIKES_REMAINING,
-                         'The average strikes remaining is {:.2f}'.
-                         format(average))
-
-    @endpoints.method(request_message=USER_REQUEST,
+    @endpoints.method(request_message=USER_PAGE_REQUEST,
                       response_message=GameForms,
                       path='games/user/{user_name}',
                       name='get_user_games',
                       http_method='GET')
+    @metrics.instrumented()
+    @ratelimit.limited('get_user_games', ratelimit.by_field('user_name'))
     def get_user_games(self, request):
-        """Returns all of an individual User's active games"""
-        user = User.query(User.name == request.user_name).get()
-        if not user:
+        """Returns all of an individual User's active games, one page at a
+        time"""
+        return HangmanApi._get_user_games_async(
+            request.user_name, request.page_size,
+            request.page_token).get_result()
+
+    @staticmethod
+    @ndb.tasklet
+    def _get_user_games_async(user_name, page_size, page_token):
+        """Tasklet resolving the GameForms for get_user_games"""
+        user_key = yield userdir.get_user_key_async(user_name)
+        if not user_key:
             raise endpoints.NotFoundException(
                 'A User with that name does not exist!')
-        games = Game.query(Game.user == user.key).\
+        games = Game.query(Game.user == user_key).\
             filter(Game.game_over == False)
         # I really don't understand why anaconda says I have to put
         # the 'filter' this far back.. Also forced to do == False
-        return GameForms(items=[game.to_form("") for game in games])
+        games, token = yield fetch_page_async(games, page_size, page_token)
+        forms = yield games_to_forms_async(games, "")
+        raise ndb.Return(GameForms(items=forms, next_page_token=token))
 
     @endpoints.method(request_message=GET_GAME_REQUEST,
                       response_message=GameForm,
                       path='game/cancel/{urlsafe_game_key}',
                       name='cancel_game',
                       http_method='PUT')
+    @metrics.instrumented()
+    @ratelimit.limited('cancel_game',
+                       ratelimit.by_field('urlsafe_game_key'))
     def cancel_game(self, request):
         """ends the game prematurely - no points given. Game = Over """
         # it's my belief that if you need to cancel your game, you need
@@ -224,8 +400,7 @@ class HangmanApi(remote.Service):
         # to win.
         game = get_by_urlsafe(request.urlsafe_game_key, Game)
         if not game.game_over:
-            game.strikes_remaining = 0
-            game.end_game(False)
+            game = game.end_game(False, forfeit=True)
             return game.to_form('Game canceled prematurely - Game over!')
         raise endpoints.ForbiddenException('Game already over! Cannot cancel!')
 
@@ -234,46 +409,147 @@ class HangmanApi(remote.Service):
                       path='get_scores/high',
                       name='get_high_scores',
                       http_method='GET')
+    @metrics.instrumented()
+    @ratelimit.limited('get_high_scores', ratelimit.by_client)
     def get_high_scores(self, request):
         """generates a list of game high scores in descending order; a leader-board.
            accepts optional parameter 'num_results' which limits the number of
-           returned results. Doesn't work well with Hangman since a perfect
-           game is not uncommon."""
+           returned results per page. Doesn't work well with Hangman since a
+           perfect game is not uncommon. The first num_results (up to
+           leaderboard.TOP_N) are served from the precomputed leaderboard,
+           with a page token continuing from the query."""
+        HangmanApi._check_num_results(request.num_results)
+        if request.num_results and not request.page_token and \
+                request.num_results <= leaderboard.TOP_N:
+            entries = leaderboard.get_top_scores(request.num_results)
+            return ScoreForms(items=[
+                ScoreForm(points=points, user_name=user_name, won=won,
+                          date=date) for points, user_name, won, date in
+                entries], next_page_token=HangmanApi._snapshot_token(
+                    entries, request.num_results))
         qu = Score.query().\
             order(-Score.points).\
             order(Score.date)
-        if request.num_results:
-            return ScoreForms(items=[score.to_form() for score in qu.
-                                     fetch(limit=request.num_results)])
-        return ScoreForms(items=[score.to_form() for score in qu])
+        return HangmanApi._get_scores_async(
+            qu, request.num_results, request.page_token).get_result()
 
     @endpoints.method(request_message=NUMBER_RESULTS_REQUEST,
                       response_message=UserForms,
                       path='userranks',
                       name='get_user_rankings',
                       http_method='GET')
+    @metrics.instrumented()
+    @ratelimit.limited('get_user_rankings', ratelimit.by_client)
     def get_user_rankings(self, request):
         """generates ranked list (leaderboard) of users based on user performance,
-        then by career points, then by fewest games played"""
+        then by career points, then by fewest games played. The first
+        num_results (up to leaderboard.TOP_N) are served from the
+        precomputed leaderboard, with a page token continuing from the
+        query."""
+        HangmanApi._check_num_results(request.num_results)
+        if request.num_results and not request.page_token and \
+                request.num_results <= leaderboard.TOP_N:
+            entries = leaderboard.get_top_users(request.num_results)
+            return UserForms(items=[
+                UserForm(name=name, games_played=games_played,
+                         career_points=career_points,
+                         performance=float(performance))
+                for name, games_played, career_points, performance in
+                entries], next_page_token=HangmanApi._snapshot_token(
+                    entries, request.num_results))
         qu = User.query().\
             order(-User.performance).\
             order(-User.career_points).\
             order(User.games_played)
         if not qu:
             raise endpoints.NotFoundException('There are no rankings!')
-        if request.num_results:
-            return UserForms(items=[user.to_form() for user in qu.
-                                    fetch(limit=request.num_results)])
-        return UserForms(items=[user.to_form() for user in qu])
+        users, token = fetch_page(qu, request.num_results, request.page_token)
+        return UserForms(items=[user.to_form() for user in users],
+                         next_page_token=token)
+
+    @staticmethod
+    def _check_num_results(num_results):
+        """Rejects a num_results below 1"""
+        if num_results is not None and num_results < 1:
+            raise endpoints.BadRequestException(
+                'num_results must be at least 1')
+
+    @staticmethod
+    def _snapshot_token(entries, num_results):
+        """Returns the page token continuing after a full page served from
+        a leaderboard snapshot, or None if the snapshot held fewer"""
+        if len(entries) < num_results:
+            return None
+        return offset_page_token(len(entries))
+
+    @endpoints.method(request_message=USER_REQUEST,
+                      response_message=RankForm,
+                      path='userranks/{user_name}',
+                      name='get_my_rank',
+                      http_method='GET')
+    @metrics.instrumented()
+    @ratelimit.limited('get_my_rank', ratelimit.by_field('user_name'))
+    def get_my_rank(self, request):
+        """Returns a User's rank among all users, looked up from the
+        precomputed rank band counts"""
+        # The User and the band counts don't depend on each other, so they
+        # are fetched concurrently.
+        user_future = userdir.get_user_async(request.user_name)
+        counts_future = leaderboard.get_band_counts_async()
+        user = user_future.get_result()
+        if not user:
+            raise endpoints.NotFoundException(
+                'A User with that name does not exist!')
+        rank, tied, total = leaderboard.get_rank(user,
+                                                 counts_future.get_result())
+        return RankForm(user_name=user.name, rank=rank, tied=tied,
+                        total_users=total,
+                        performance=float(user.performance))
 
     @endpoints.method(request_message=GET_GAME_REQUEST,
                       response_message=GameHistoryForm,
                       path='history/{urlsafe_game_key}',
                       name='get_game_history',
                       http_method='GET')
+    @metrics.instrumented()
     def get_game_history(self, request):
-        """returns the move history of a given game as JSON"""
-        game = get_by_urlsafe(request.urlsafe_game_key, Game)
-        return game.history_to_form()
+        """returns the move history of a given game as JSON, including
+        games that have been archived. Cached like get_game."""
+        return formcache.get_form(
+            GameHistoryForm, 'get_game_history', request.urlsafe_game_key,
+            self._if_none_match(),
+            lambda: HangmanApi._get_game_history(request.urlsafe_game_key))
+
+    @staticmethod
+    def _get_game_history(urlsafe_game_key):
+        """Returns the GameHistoryForm for get_game_history and the version
+        of the game it was built from"""
+        game_key = get_key_by_urlsafe(urlsafe_game_key, Game)
+        game = archive.get_game_async(game_key).get_result()
+        if not game:
+            raise endpoints.NotFoundException('Game not found!')
+        return game.history_to_form(), game.version
+
+    @endpoints.method(request_message=GAME_MOVES_REQUEST,
+                      response_message=MoveForms,
+                      path='history/{urlsafe_game_key}/moves',
+                      name='get_game_moves',
+                      http_method='GET')
+    @metrics.instrumented()
+    @ratelimit.limited('get_game_moves',
+                       ratelimit.by_field('urlsafe_game_key'))
+    def get_game_moves(self, request):
+        """returns a range of the moves made in a given game, starting at the
+        optional 'offset' and limited to the optional 'limit' moves"""
+        if (request.offset or 0) < 0 or (request.limit or 0) < 0:
+            raise endpoints.BadRequestException(
+                'offset and limit must not be negative')
+        game_key = get_key_by_urlsafe(request.urlsafe_game_key, Game)
+        game = archive.get_game_async(game_key).get_result()
+        if not game:
+            raise endpoints.NotFoundException('Game not found!')
+        return game.moves_to_form(request.offset or 0, request.limit)
 
 api = endpoints.api_server([HangmanApi])
+
+metrics.record('import api', (time.time() - _import_started) * 1000)
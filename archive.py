@@ -0,0 +1,220 @@
+"""archive.py - Archival of finished games. A daily compaction run moves
+Games that ended more than ARCHIVE_AFTER_DAYS ago out of the Game kind
+into GameArchive blocks, one per User per month (more if a month holds
+over MAX_GAMES_PER_BLOCK games), each packing its games into a single
+compressed property. That keeps the indexes the active game queries scan
+down to recent games. Every archived game gets an ArchivedGame pointer
+keyed by its old id, so its history can still be found with two key gets.
+
+Blocks expire ARCHIVE_TTL_DAYS after the end of their month and are
+deleted, with their pointers, by a daily purge run.
+
+Both runs are chains of batch tasks, and both take their cutoffs from the
+clock when each batch runs rather than from anything in the task request.
+Finished Games from before the Game ended property existed are given the
+time they are found as their end by visiting /tasks/backfill_game_ends as
+an admin once, so they are archived ARCHIVE_AFTER_DAYS later."""
+
+import logging
+import time
+from datetime import datetime, timedelta
+from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+
+from models import Game, resolve_user_names
+
+ARCHIVE_AFTER_DAYS = 30
+ARCHIVE_TTL_DAYS = 730
+BATCH_SIZE = 200
+# An archived game takes up to a few hundred bytes, so a full block stays
+# well under the 1MB entity limit.
+MAX_GAMES_PER_BLOCK = 2000
+PURGE_BATCH_SIZE = 5
+BACKFILL_BATCH_SIZE = 200
+COMPACT_URL = '/tasks/compact_games'
+PURGE_URL = '/tasks/purge_archives'
+BACKFILL_URL = '/tasks/backfill_game_ends'
+
+
+class GameArchive(ndb.Model):
+    """A block of one User's finished games from one month. A child of the
+    User with the month (YYYY-MM) as its id, followed by the block number
+    after the first block. Each record is a list of the game's id,
+    user_name, target_string, moves, strikes_remaining and pack."""
+    records = ndb.JsonProperty(compressed=True, default=[])
+    expires = ndb.DateTimeProperty(required=True)
+
+
+class ArchivedGame(ndb.Model):
+    """Points from the id of an archived Game to its GameArchive block"""
+    archive = ndb.KeyProperty(kind=GameArchive, required=True,
+                              indexed=False)
+
+
+def _record(game, user_name):
+    moves = ''.join('{}{}{}'.format(guess, '+' if hit else '-', strikes)
+                    for guess, hit, strikes in game.get_moves())
+    return [game.key.id(), user_name, game.target_string, moves,
+            game.strikes_remaining, game.pack]
+
+
+def _game_from_record(block_key, record):
+    """Returns an unsaved Game rebuilt from an archive record. It is only
+    meant to be read from, e.g. to build forms."""
+    game_id, user_name, target_string, moves, strikes_remaining, pack = \
+        record
+    return Game(key=ndb.Key(Game, game_id), user=block_key.parent(),
+                user_name=user_name, target_string=target_string,
+                guessed_letters=moves[::3], moves=moves,
+                strikes_remaining=strikes_remaining, pack=pack,
+                game_over=True)
+
+
+@ndb.tasklet
+def get_game_async(game_key):
+    """Tasklet resolving the Game with game_key, rebuilt from its archive
+    block if it has been archived, or None if there is no such Game"""
+    game, pointer = yield ndb.get_multi_async(
+        [game_key, ndb.Key(ArchivedGame, game_key.id())])
+    if game or not pointer:
+        raise ndb.Return(game)
+    block = yield pointer.archive.get_async()
+    for record in block.records if block else []:
+        if record[0] == game_key.id():
+            raise ndb.Return(_game_from_record(block.key, record))
+    raise ndb.Return(None)
+
+
+def _block_id(month, number):
+    return month if not number else '{}.{}'.format(month, number)
+
+
+def _expiry(month):
+    year, number = [int(part) for part in month.split('-')]
+    end = datetime(year + number // 12, number % 12 + 1, 1)
+    return end + timedelta(days=ARCHIVE_TTL_DAYS)
+
+
+@ndb.transactional
+def _add_to_blocks(user_key, month, records):
+    """Adds records to the first of a User's blocks for month with room,
+    skipping any already archived, and returns the key of the block
+    holding each record's game by game id"""
+    archived = {}
+    number = 0
+    target = None
+    while True:
+        key = ndb.Key(GameArchive, _block_id(month, number), parent=user_key)
+        block = key.get()
+        if block is None:
+            target = target or GameArchive(key=key, records=[],
+                                           expires=_expiry(month))
+            break
+        for record in block.records:
+            archived[record[0]] = key
+        if target is None and \
+                len(block.records) + len(records) <= MAX_GAMES_PER_BLOCK:
+            target = block
+        number += 1
+    new = [record for record in records if record[0] not in archived]
+    if new:
+        target.records = target.records + new
+        target.put()
+        for record in new:
+            archived[record[0]] = target.key
+    return archived
+
+
+def start_compaction():
+    """Enqueues the first batch of a new compaction run"""
+    run = str(int(time.time()))
+    _enqueue(COMPACT_URL, 'compact', run, 0)
+    return run
+
+
+def start_purge():
+    """Enqueues the first batch of a new purge run"""
+    run = str(int(time.time()))
+    _enqueue(PURGE_URL, 'purge', run, 0)
+    return run
+
+
+def _enqueue(url, prefix, run, number, cursor=None):
+    params = {'run': run, 'batch': number}
+    if cursor:
+        params['cursor'] = cursor.urlsafe()
+    # Naming the task after the run and batch makes a retried batch that
+    # already enqueued its successor a no-op.
+    try:
+        taskqueue.add(url=url, params=params,
+                      name='{}-{}-{}'.format(prefix, run, number))
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        pass
+
+
+def backfill_batch(cursor=None):
+    """Gives the finished Games in one batch that have no end time the
+    current time, starting at cursor (a urlsafe cursor string, or None for
+    the first batch), and enqueues the next batch if there is more to do"""
+    # Games written before ended existed don't have the property at all,
+    # and such entities never match a filter on it, so every finished Game
+    # is walked and checked here instead.
+    games, next_cursor, more = Game.query(Game.game_over == True).fetch_page(
+        BACKFILL_BATCH_SIZE,
+        start_cursor=Cursor(urlsafe=cursor) if cursor else None)
+    legacy = [game for game in games if game.ended is None]
+    now = datetime.utcnow()
+    for game in legacy:
+        game.ended = now
+    ndb.put_multi(legacy)
+    logging.info('Backfilled end times of {} of {} finished games'.format(
+        len(legacy), len(games)))
+    if more and next_cursor:
+        taskqueue.add(url=BACKFILL_URL,
+                      params={'cursor': next_cursor.urlsafe()})
+
+
+def compact_batch(run, number, cursor=None):
+    """Archives one batch of the finished Games that ended over
+    ARCHIVE_AFTER_DAYS ago, starting at cursor (a urlsafe cursor string, or
+    None for the first batch), and enqueues the next"""
+    cutoff = datetime.utcnow() - timedelta(days=ARCHIVE_AFTER_DAYS)
+    games, next_cursor, more = Game.query(
+        Game.game_over == True, Game.ended < cutoff).fetch_page(
+        BATCH_SIZE, start_cursor=Cursor(urlsafe=cursor) if cursor else None)
+    user_names = resolve_user_names(games)
+    groups = {}
+    for game in games:
+        month = game.ended.strftime('%Y-%m')
+        groups.setdefault((game.user, month), []).append(
+            _record(game, game.user_name or user_names.get(game.user)))
+    pointers = []
+    for (user_key, month), records in groups.items():
+        archived = _add_to_blocks(user_key, month, records)
+        pointers.extend(ArchivedGame(id=record[0],
+                                     archive=archived[record[0]])
+                        for record in records)
+    # Games are only deleted once their blocks and pointers are written, so
+    # a batch that fails part way is simply archived again when retried.
+    ndb.put_multi(pointers)
+    ndb.delete_multi([game.key for game in games])
+    logging.info('Compaction run {} batch {}: archived {} games into {} '
+                 'blocks'.format(run, number, len(games), len(groups)))
+    if more and next_cursor:
+        _enqueue(COMPACT_URL, 'compact', run, number + 1, next_cursor)
+
+
+def purge_batch(run, number):
+    """Deletes one batch of expired archive blocks and their pointers, and
+    enqueues the next batch if there may be more"""
+    expired = GameArchive.query(
+        GameArchive.expires < datetime.utcnow()).fetch(PURGE_BATCH_SIZE)
+    pointer_keys = [ndb.Key(ArchivedGame, record[0])
+                    for block in expired for record in block.records]
+    ndb.delete_multi(pointer_keys)
+    ndb.delete_multi([block.key for block in expired])
+    logging.info('Purge run {} batch {}: deleted {} blocks of {} '
+                 'games'.format(run, number, len(expired), len(pointer_keys)))
+    if len(expired) == PURGE_BATCH_SIZE:
+        _enqueue(PURGE_URL, 'purge', run, number + 1)
@@ -0,0 +1,301 @@
+#!/usr/bin/env python
+
+"""benchmark.py - Local load test for the Hangman API. Runs against the App
+Engine SDK's testbed stubs for the datastore, memcache and task queue, and
+reports, for each endpoint, the p50/p95/p99 latency, the datastore and
+memcache RPCs made and the bytes of the serialized responses, as JSON so
+results can be compared between versions.
+
+Two scenarios are available:
+    play    Each simulated player goes through create_user, new_game,
+            make_move until the game is over, then get_high_scores.
+    reads   Seeds players, games and scores, then times get_game,
+            get_user_games and get_scores against a serial version of
+            each (one blocking datastore call after another, a user get
+            per row), to show what the tasklet read paths save.
+
+The stubs answer instantly, so --rpc-latency-ms adds a simulated round
+trip to every API call.
+
+Usage:
+    python benchmark.py [--scenario play|reads] [--players N] [--seed N]
+                        [--rpc-latency-ms MS] [--label LABEL]
+                        [--output FILE] [--sdk PATH]
+
+The SDK is found through --sdk, the APPENGINE_SDK environment variable or
+an importable dev_appserver module."""
+
+import argparse
+import json
+import os
+import random
+import string
+import sys
+import time
+
+DEFAULT_PLAYERS = 1000
+GAMES_PER_PLAYER = 5
+FINISHED_PER_PLAYER = 2
+
+
+def setup_sdk(sdk_path):
+    """Puts the App Engine SDK and its bundled libraries on sys.path"""
+    if sdk_path:
+        sys.path.insert(0, sdk_path)
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+
+def start_testbed():
+    """Activates the stubs the API uses and returns the Testbed"""
+    from google.appengine.datastore import datastore_stub_util
+    from google.appengine.ext import testbed
+    os.environ.setdefault('SERVER_SOFTWARE', 'Development/benchmark')
+    bed = testbed.Testbed()
+    bed.activate()
+    policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(
+        probability=1)
+    bed.init_datastore_v3_stub(consistency_policy=policy)
+    bed.init_memcache_stub()
+    bed.init_taskqueue_stub(
+        root_path=os.path.dirname(os.path.abspath(__file__)))
+    bed.init_app_identity_stub()
+    bed.init_mail_stub()
+    return bed
+
+
+def simulate_rpc_latency(milliseconds):
+    """Makes every API call take at least milliseconds longer"""
+    from google.appengine.api import apiproxy_stub_map
+
+    def sleep(service, call, request, response):
+        time.sleep(milliseconds / 1000.0)
+    apiproxy_stub_map.apiproxy.GetPreCallHooks().Append('latency', sleep)
+
+
+def percentile(values, fraction):
+    """Returns the nearest-rank percentile of a sorted list"""
+    if not values:
+        return 0.0
+    index = max(int(round(fraction * len(values))) - 1, 0)
+    return values[min(index, len(values) - 1)]
+
+
+class Recorder(object):
+    """Calls endpoint methods and records their cost"""
+
+    def __init__(self):
+        self.samples = {}
+
+    def call(self, service, name, container, **fields):
+        """Calls an endpoint method of service with a request built from
+        fields"""
+        request = container.combined_message_class(**fields)
+        return self.measure(name, getattr(service, name), request)
+
+    def measure(self, name, func, *args):
+        """Calls func, recording its cost under name. Each call gets a fresh
+        ndb context cache, as each request would."""
+        from google.appengine.ext import ndb
+        from protorpc import messages, protojson
+        from utils import count_rpcs
+        ndb.get_context().clear_cache()
+        started = time.time()
+        with count_rpcs() as counts:
+            response = func(*args)
+        elapsed = (time.time() - started) * 1000
+        sample = self.samples.setdefault(name, {
+            'latencies': [], 'datastore_rpcs': 0, 'memcache_rpcs': 0,
+            'bytes': 0})
+        sample['latencies'].append(elapsed)
+        sample['datastore_rpcs'] += counts.get('datastore_v3', 0)
+        sample['memcache_rpcs'] += counts.get('memcache', 0)
+        if isinstance(response, messages.Message):
+            sample['bytes'] += len(protojson.encode_message(response))
+        return response
+
+    def report(self):
+        endpoints = {}
+        for name, sample in sorted(self.samples.items()):
+            latencies = sorted(sample['latencies'])
+            calls = len(latencies)
+            endpoints[name] = {
+                'calls': calls,
+                'p50_ms': round(percentile(latencies, 0.50), 3),
+                'p95_ms': round(percentile(latencies, 0.95), 3),
+                'p99_ms': round(percentile(latencies, 0.99), 3),
+                'datastore_rpcs': sample['datastore_rpcs'],
+                'datastore_rpcs_per_call': round(
+                    float(sample['datastore_rpcs']) / calls, 3),
+                'memcache_rpcs': sample['memcache_rpcs'],
+                'memcache_rpcs_per_call': round(
+                    float(sample['memcache_rpcs']) / calls, 3),
+                'bytes': sample['bytes'],
+                'bytes_per_call': round(float(sample['bytes']) / calls, 1),
+            }
+        return endpoints
+
+
+def play(recorder, service, player):
+    """Plays one player's session"""
+    import api
+    name = 'player{}'.format(player)
+    recorder.call(service, 'create_user', api.USER_REQUEST, user_name=name,
+                  email='{}@example.com'.format(name))
+    game = recorder.call(service, 'new_game', api.NEW_GAME_REQUEST,
+                         user_name=name)
+    letters = list(string.ascii_lowercase)
+    random.shuffle(letters)
+    for letter in letters:
+        game = recorder.call(service, 'make_move', api.MAKE_MOVE_REQUEST,
+                             urlsafe_game_key=game.urlsafe_key,
+                             guess=letter)
+        if game.game_over:
+            break
+    recorder.call(service, 'get_high_scores', api.NUMBER_RESULTS_REQUEST,
+                  num_results=10)
+
+
+def run_play(players):
+    """Runs the simulated players and returns the per-endpoint report"""
+    import api
+    service = api.HangmanApi()
+    recorder = Recorder()
+    for player in range(players):
+        play(recorder, service, player)
+    return recorder.report()
+
+
+def seed_reads(players):
+    """Creates players with some active and some finished games. Returns
+    the player names and the urlsafe keys of the games."""
+    import api
+    service = api.HangmanApi()
+    names = []
+    game_keys = []
+    for player in range(players):
+        name = 'reader{}'.format(player)
+        service.create_user(api.USER_REQUEST.combined_message_class(
+            user_name=name))
+        names.append(name)
+        for number in range(GAMES_PER_PLAYER):
+            game = service.new_game(
+                api.NEW_GAME_REQUEST.combined_message_class(user_name=name))
+            game_keys.append(game.urlsafe_key)
+            if number < FINISHED_PER_PLAYER:
+                service.cancel_game(
+                    api.GET_GAME_REQUEST.combined_message_class(
+                        urlsafe_game_key=game.urlsafe_key))
+    return names, game_keys
+
+
+def serial_get_game(urlsafe_game_key):
+    """get_game with blocking calls: the game, then its user if the game
+    has no stored user name"""
+    from google.appengine.ext import ndb
+    game = ndb.Key(urlsafe=urlsafe_game_key).get()
+    return game.get_user_name()
+
+
+def serial_get_user_games(user_name):
+    """get_user_games with blocking calls: the user, the games, then a user
+    get per game that has no stored user name"""
+    from models import User, Game
+    user = User.query(User.name == user_name).get()
+    games = Game.query(Game.user == user.key).\
+        filter(Game.game_over == False).fetch()
+    return [game.get_user_name() for game in games]
+
+
+def serial_get_scores():
+    """get_scores with blocking calls: the scores, then a user get per
+    score that has no stored user name"""
+    from models import Score
+    from utils import MAX_PAGE_SIZE
+    return [score.user_name or score.user.get().name
+            for score in Score.query().fetch(MAX_PAGE_SIZE)]
+
+
+def run_reads(players):
+    """Times the tasklet read paths against their serial versions and
+    returns the per-endpoint report"""
+    import api
+    service = api.HangmanApi()
+    names, game_keys = seed_reads(players)
+    recorder = Recorder()
+    for name, urlsafe_game_key in zip(names, game_keys):
+        recorder.call(service, 'get_game', api.GET_GAME_REQUEST,
+                      urlsafe_game_key=urlsafe_game_key)
+        recorder.measure('serial_get_game', serial_get_game,
+                         urlsafe_game_key)
+        recorder.call(service, 'get_user_games', api.USER_PAGE_REQUEST,
+                      user_name=name)
+        recorder.measure('serial_get_user_games', serial_get_user_games,
+                         name)
+        recorder.call(service, 'get_scores', api.PAGE_REQUEST)
+        recorder.measure('serial_get_scores', serial_get_scores)
+    report = recorder.report()
+    for name in ('get_game', 'get_user_games', 'get_scores'):
+        serial = report['serial_' + name]['p50_ms']
+        if serial:
+            report[name]['p50_reduction_pct'] = round(
+                100 * (serial - report[name]['p50_ms']) / serial, 1)
+    return report
+
+
+def run(scenario, players, seed):
+    """Runs a scenario and returns the per-endpoint report and the time it
+    took"""
+    random.seed(seed)
+    started = time.time()
+    if scenario == 'reads':
+        report = run_reads(players)
+    else:
+        report = run_play(players)
+    return report, time.time() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Local load test for the Hangman API.')
+    parser.add_argument('--scenario', choices=('play', 'reads'),
+                        default='play')
+    parser.add_argument('--players', type=int, default=DEFAULT_PLAYERS)
+    parser.add_argument('--rpc-latency-ms', type=float, default=0,
+                        help='Simulated round trip added to every API call')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--label', default='',
+                        help='Version label stored with the results')
+    parser.add_argument('--output', help='File to write the JSON to '
+                                         '(default stdout)')
+    parser.add_argument('--sdk', default=os.environ.get('APPENGINE_SDK'),
+                        help='Path to the App Engine SDK')
+    args = parser.parse_args()
+
+    setup_sdk(args.sdk)
+    bed = start_testbed()
+    if args.rpc_latency_ms:
+        simulate_rpc_latency(args.rpc_latency_ms)
+    try:
+        endpoints, elapsed = run(args.scenario, args.players, args.seed)
+    finally:
+        bed.deactivate()
+    results = json.dumps({
+        'label': args.label,
+        'scenario': args.scenario,
+        'players': args.players,
+        'rpc_latency_ms': args.rpc_latency_ms,
+        'seed': args.seed,
+        'elapsed_s': round(elapsed, 3),
+        'endpoints': endpoints,
+    }, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(results + '\n')
+    else:
+        print(results)
+
+
+if __name__ == '__main__':
+    main()
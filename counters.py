@@ -0,0 +1,156 @@
+"""counters.py - Sharded running counters for the active (unfinished) Games.
+Keeping the number of active Games and their total strikes remaining as
+counters means the average strikes remaining can be read without scanning
+every Game. Writes are spread over several shard entities so that busy
+periods don't contend on a single entity group."""
+
+import logging
+import random
+import time
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+NUM_SHARDS = 20
+MEMCACHE_ACTIVE_GAMES = 'ACTIVE_GAMES'
+MEMCACHE_ACTIVE_STRIKES = 'ACTIVE_STRIKES'
+MEMCACHE_DRIFT = 'ACTIVE_DRIFT'
+# The cached totals expire so that an increment lost between reading the
+# shards and caching their totals doesn't stay lost.
+CACHE_SECONDS = 300
+# A previous run's drift older than this no longer confirms a new one.
+DRIFT_SECONDS = 3600
+# Reconciliation tasks are named after the window they were enqueued in, so
+# any number of enqueues within one window collapse into a single task.
+RECONCILE_WINDOW = 300
+RECONCILE_URL = '/tasks/cache_average_strikes'
+
+
+class ActiveGamesShard(ndb.Model):
+    """One shard of the active Game count and total strikes remaining"""
+    games = ndb.IntegerProperty(required=True, default=0, indexed=False)
+    strikes = ndb.IntegerProperty(required=True, default=0, indexed=False)
+
+
+def _shard_keys():
+    return [ndb.Key(ActiveGamesShard, str(i)) for i in range(NUM_SHARDS)]
+
+
+@ndb.transactional
+def _increment_shard(key, games, strikes):
+    shard = key.get() or ActiveGamesShard(key=key)
+    shard.games += games
+    shard.strikes += strikes
+    shard.put()
+
+
+def increment(games=0, strikes=0):
+    """Adds games and strikes (either may be negative) to the active Game
+    counters"""
+    if not games and not strikes:
+        return
+    key = ndb.Key(ActiveGamesShard, str(random.randint(0, NUM_SHARDS - 1)))
+    _increment_shard(key, games, strikes)
+    # Only adjust the cached totals if they are present; a missing total is
+    # recomputed from the shards on the next read.
+    memcache.offset_multi({MEMCACHE_ACTIVE_GAMES: games,
+                           MEMCACHE_ACTIVE_STRIKES: strikes})
+
+
+def get_totals():
+    """Returns a (games, strikes) tuple of the active Game counters"""
+    cached = memcache.get_multi([MEMCACHE_ACTIVE_GAMES,
+                                 MEMCACHE_ACTIVE_STRIKES])
+    if len(cached) == 2:
+        return (cached[MEMCACHE_ACTIVE_GAMES],
+                cached[MEMCACHE_ACTIVE_STRIKES])
+    games = strikes = 0
+    for shard in ndb.get_multi(_shard_keys()):
+        if shard:
+            games += shard.games
+            strikes += shard.strikes
+    memcache.add_multi({MEMCACHE_ACTIVE_GAMES: games,
+                        MEMCACHE_ACTIVE_STRIKES: strikes},
+                       time=CACHE_SECONDS)
+    return games, strikes
+
+
+def _shard_totals():
+    games = strikes = 0
+    for shard in ndb.get_multi(_shard_keys(), use_cache=False,
+                               use_memcache=False):
+        if shard:
+            games += shard.games
+            strikes += shard.strikes
+    return games, strikes
+
+
+def _confirmed(drift, previous):
+    """Returns the part of drift that the previous run also found: the
+    smaller of the two if they are in the same direction, otherwise 0"""
+    if drift * previous <= 0:
+        return 0
+    return min(drift, previous, key=abs)
+
+
+def reconcile(games, strikes, counted_from):
+    """Corrects drift in the counters given the number of active games and
+    their total strikes remaining counted by a scan, and the (games,
+    strikes) the shards held when the scan started. Games played during the
+    scan may or may not have been seen by it, so a single run's difference
+    isn't trusted on its own: only the part of it that the previous run
+    also found is written to the first shard. A steady drift is therefore
+    corrected over two runs, however busy the game is."""
+    drift = (games - counted_from[0], strikes - counted_from[1])
+    previous = memcache.get(MEMCACHE_DRIFT)
+    memcache.set(MEMCACHE_DRIFT, drift, time=DRIFT_SECONDS)
+    if drift != (0, 0):
+        logging.info('Active game counters differ from the count by {} '
+                     'games and {} strikes (previous run: {})'.format(
+                         drift[0], drift[1], previous))
+    if previous is None:
+        return
+    games_fix = _confirmed(drift[0], previous[0])
+    strikes_fix = _confirmed(drift[1], previous[1])
+    if games_fix or strikes_fix:
+        logging.warning('Active game counters drifted, correcting by {} '
+                        'games and {} strikes'.format(games_fix,
+                                                      strikes_fix))
+        _increment_shard(_shard_keys()[0], games_fix, strikes_fix)
+        # The correction is already in the shards; record what is left of
+        # the drift, so the next run doesn't confirm it a second time.
+        memcache.set(MEMCACHE_DRIFT, (drift[0] - games_fix,
+                                      drift[1] - strikes_fix),
+                     time=DRIFT_SECONDS)
+    # The cached totals are rebuilt from the shards on the next read.
+    memcache.delete_multi([MEMCACHE_ACTIVE_GAMES, MEMCACHE_ACTIVE_STRIKES])
+
+
+def recount():
+    """Reconciles the counters with the active Games themselves. The
+    counters are kept up to date as games are played, so this only corrects
+    drift (e.g. from a failed counter update)."""
+    from models import Game
+    logging.info('Going to reconcile the active game counters')
+    counted_from = _shard_totals()
+    count = total_strikes_remaining = 0
+    # (not Game.game_over) isn't a datastore filter, so == False it is.
+    qu = Game.query(Game.game_over == False,
+                    projection=[Game.strikes_remaining])
+    for game in qu.iter(batch_size=500):
+        count += 1
+        total_strikes_remaining += game.strikes_remaining
+    logging.info('Active games: {}, strikes remaining: {}'.format(
+        count, total_strikes_remaining))
+    reconcile(count, total_strikes_remaining, counted_from)
+
+
+def schedule_reconcile():
+    """Enqueues a reconciliation task, unless one has already been enqueued
+    in the current time window"""
+    window = int(time.time()) // RECONCILE_WINDOW
+    try:
+        taskqueue.add(url=RECONCILE_URL,
+                      name='cache-average-strikes-{}'.format(window))
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        pass
@@ -0,0 +1,63 @@
+"""engine.py - The Hangman move engine. Guessed letters are tracked as a
+26-bit mask (bit 0 for 'a' through bit 25 for 'z'), and each target word is
+indexed once into its own letter mask and a letter-to-positions map. That
+makes checking a guess and testing for a win constant time, and lets the
+shown string be derived in a single pass over the word when it's needed."""
+
+import string
+
+BLANK = '_'
+MAX_INDEXED_WORDS = 10000
+
+_word_index = {}
+
+
+def is_letter(guess):
+    """Returns True if guess is a single English letter"""
+    return len(guess) == 1 and guess in string.ascii_letters
+
+
+def letter_bit(letter):
+    """Returns the mask bit of a lowercase letter"""
+    return 1 << (ord(letter) - ord('a'))
+
+
+def letter_mask(letters):
+    """Returns the mask of every lowercase letter in letters"""
+    mask = 0
+    for letter in letters:
+        if 'a' <= letter <= 'z':
+            mask |= letter_bit(letter)
+    return mask
+
+
+def index_word(word):
+    """Returns a (mask, positions) tuple for word, where positions maps each
+    letter of the word to the tuple of indexes it appears at"""
+    index = _word_index.get(word)
+    if index is None:
+        positions = {}
+        for i, letter in enumerate(word):
+            positions.setdefault(letter, []).append(i)
+        index = (letter_mask(word),
+                 dict((l, tuple(p)) for l, p in positions.items()))
+        if len(_word_index) >= MAX_INDEXED_WORDS:
+            _word_index.clear()
+        _word_index[word] = index
+    return index
+
+
+def is_hit(word, letter):
+    """Returns True if letter appears in word"""
+    return letter in index_word(word)[1]
+
+
+def is_solved(word, guessed_mask):
+    """Returns True if every letter of word has been guessed"""
+    return index_word(word)[0] & ~guessed_mask == 0
+
+
+def shown_string(word, guessed_mask):
+    """Returns word with every letter that hasn't been guessed blanked"""
+    return ''.join(letter if guessed_mask & letter_bit(letter) else BLANK
+                   for letter in word)
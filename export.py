@@ -0,0 +1,202 @@
+"""export.py - Bulk export of Users, Games and Scores for analytics. An
+export walks each kind with a projection query, a batch at a time, and
+writes every batch as a newline-delimited JSON part to a sink: a directory
+of local files (for the development server and offline runs) or a Cloud
+Storage bucket. Batches are chained through the task queue, and after each
+one the job's position is checkpointed in its ExportJob, so memory use
+doesn't grow with the export and an interrupted export can be resumed
+where it stopped.
+
+Each job has its own batch size and delay between batches, which set how
+hard it works the datastore; the defaults keep an export well clear of
+player traffic."""
+
+import json
+import logging
+import os
+from datetime import datetime
+from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+
+try:
+    import cloudstorage
+except ImportError:
+    cloudstorage = None
+
+from models import User, Game, Score
+
+BATCH_URL = '/tasks/export'
+DEFAULT_BATCH_SIZE = 500
+DEFAULT_DELAY_SECONDS = 2
+MAX_BATCH_SIZE = 1000
+
+FILE_SINK = 'file'
+GCS_SINK = 'gcs'
+
+# (kind name, model, projected properties) of each kind exported. Only
+# properties every entity of the kind has are projected, as a projection
+# query skips entities missing any of them.
+KINDS = [
+    ('User', User, [User.name, User.games_played, User.career_points]),
+    ('Game', Game, [Game.user, Game.game_over, Game.strikes_remaining]),
+    ('Score', Score, [Score.user, Score.date, Score.won, Score.points]),
+]
+
+
+class ExportJob(ndb.Model):
+    """The progress of one export, checkpointed after every batch"""
+    sink = ndb.StringProperty(required=True, indexed=False)
+    destination = ndb.StringProperty(required=True, indexed=False)
+    batch_size = ndb.IntegerProperty(required=True, indexed=False)
+    delay_seconds = ndb.IntegerProperty(required=True, indexed=False)
+    # The number of the next batch, the index in KINDS of the kind it reads
+    # and the cursor it starts at.
+    batch = ndb.IntegerProperty(default=0, indexed=False)
+    kind_index = ndb.IntegerProperty(default=0, indexed=False)
+    cursor = ndb.StringProperty(indexed=False)
+    records = ndb.IntegerProperty(default=0, indexed=False)
+    started = ndb.DateTimeProperty(auto_now_add=True)
+    finished = ndb.DateTimeProperty()
+
+
+class FileSink(object):
+    """Writes parts as files in a local directory"""
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def write(self, name, lines):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        path = os.path.join(self.directory, name)
+        # Written under a temporary name first so a part is either complete
+        # or missing.
+        with open(path + '.tmp', 'w') as f:
+            for line in lines:
+                f.write(line)
+        os.rename(path + '.tmp', path)
+
+
+class GcsSink(object):
+    """Writes parts as objects under a Cloud Storage path (/bucket/prefix)"""
+
+    def __init__(self, path):
+        if cloudstorage is None:
+            raise ValueError('The cloudstorage library is not installed')
+        self.path = path.rstrip('/')
+
+    def write(self, name, lines):
+        with cloudstorage.open('{}/{}'.format(self.path, name), 'w',
+                               content_type='application/x-ndjson') as f:
+            for line in lines:
+                f.write(line)
+
+
+def get_sink(sink, destination):
+    """Returns the sink of type sink (FILE_SINK or GCS_SINK) writing to
+    destination.
+    Raises:
+        ValueError: If the sink type is unknown or unavailable"""
+    if sink == FILE_SINK:
+        return FileSink(destination)
+    if sink == GCS_SINK:
+        return GcsSink(destination)
+    raise ValueError('Unknown sink: {}'.format(sink))
+
+
+def _value(value):
+    if isinstance(value, ndb.Key):
+        return value.urlsafe()
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    return value
+
+
+def _lines(kind, entities, properties):
+    """Yields the NDJSON line of each projected entity"""
+    names = [prop._name for prop in properties]
+    for entity in entities:
+        record = {'kind': kind, 'key': entity.key.urlsafe()}
+        for name in names:
+            record[name] = _value(getattr(entity, name))
+        yield json.dumps(record, sort_keys=True) + '\n'
+
+
+def start_export(sink, destination, batch_size=DEFAULT_BATCH_SIZE,
+                 delay_seconds=DEFAULT_DELAY_SECONDS):
+    """Creates an ExportJob, enqueues its first batch and returns its id.
+    Raises:
+        ValueError: If the sink is unknown or unavailable"""
+    if not destination:
+        raise ValueError('No destination given')
+    get_sink(sink, destination)
+    # An allocated id can't be handed to two exports, even ones started
+    # in the same second.
+    job = ExportJob(id=str(ExportJob.allocate_ids(1)[0]), sink=sink,
+                    destination=destination,
+                    batch_size=min(max(batch_size, 1), MAX_BATCH_SIZE),
+                    delay_seconds=max(delay_seconds, 0))
+    job.put()
+    _enqueue(job, named=True)
+    return job.key.id()
+
+
+def resume_export(job_id):
+    """Enqueues the next batch of an interrupted ExportJob again.
+    Raises:
+        ValueError: If there is no such unfinished job"""
+    job = ExportJob.get_by_id(job_id)
+    if not job or job.finished:
+        raise ValueError('No unfinished export {}'.format(job_id))
+    _enqueue(job, named=False)
+
+
+def _enqueue(job, named):
+    params = {'job': job.key.id(), 'batch': job.batch}
+    if not named:
+        taskqueue.add(url=BATCH_URL, params=params,
+                      countdown=job.delay_seconds)
+        return
+    # Naming the task after the job and batch makes a retried batch that
+    # already enqueued its successor a no-op.
+    try:
+        taskqueue.add(url=BATCH_URL, params=params,
+                      countdown=job.delay_seconds,
+                      name='export-{}-{}'.format(job.key.id(), job.batch))
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        pass
+
+
+def export_batch(job_id, number):
+    """Exports batch number of an ExportJob, checkpoints the job and
+    enqueues the next batch. Does nothing if the job has already moved past
+    that batch."""
+    job = ExportJob.get_by_id(job_id)
+    if not job or job.finished or job.batch != number:
+        return
+    kind, model, properties = KINDS[job.kind_index]
+    entities, next_cursor, more = model.query(
+        projection=properties).fetch_page(
+        job.batch_size,
+        start_cursor=Cursor(urlsafe=job.cursor) if job.cursor else None)
+    get_sink(job.sink, job.destination).write(
+        '{}-{:06d}.ndjson'.format(kind.lower(), number),
+        _lines(kind, entities, properties))
+
+    job.batch += 1
+    job.records += len(entities)
+    if more and next_cursor:
+        job.cursor = next_cursor.urlsafe()
+    else:
+        job.kind_index += 1
+        job.cursor = None
+    if job.kind_index == len(KINDS):
+        job.finished = datetime.utcnow()
+    job.put()
+    logging.info('Export {} batch {}: {} {} records{}'.format(
+        job_id, number, len(entities), kind,
+        ' (finished, {} records)'.format(job.records)
+        if job.finished else ''))
+    if not job.finished:
+        _enqueue(job, named=True)
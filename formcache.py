@@ -0,0 +1,71 @@
+"""formcache.py - Cache of serialized game responses. Every Game carries a
+version that is bumped each time it is put, and once the put has committed
+the new version is written to memcache. A response built from a Game is
+cached in memcache along with the version it was built from, and is only
+served while that version is still the Game's current one, so nothing has
+to be deleted when a Game changes.
+
+The version doubles as the response's ETag. A client that sends back the
+etag of its last response in an If-None-Match header gets a response
+holding only the etag and a not_modified flag if the Game hasn't changed
+since, which is answered from memcache alone. Endpoints can't send a 304:
+it turns any error status it doesn't know into a 404."""
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+from protorpc import protojson
+
+import metrics
+
+VERSION_PREFIX = 'GAME_VERSION:'
+FORM_PREFIX = 'GAME_FORM:'
+# Entries also expire, which bounds how long a response can outlive a Game
+# that is deleted rather than put (e.g. when it is archived).
+CACHE_SECONDS = 3600
+
+
+def etag(version):
+    """Returns the ETag of responses built from a Game version"""
+    return '"{}"'.format(version or 0)
+
+
+def game_updated(game_key, version):
+    """Records a newly written Game version, once any transaction it was
+    written in has committed"""
+    ndb.get_context().call_on_commit(
+        lambda: memcache.set(VERSION_PREFIX + game_key.urlsafe(), version,
+                             time=CACHE_SECONDS))
+
+
+def get_form(form_class, name, urlsafe_game_key, if_none_match, build):
+    """Returns the response of kind name (the endpoint) for a Game, from the
+    cache if it holds one for the Game's current version. Otherwise build is
+    called to load the Game and return a (form, version) tuple, and the form
+    is cached. The form's etag field is set. If if_none_match is the
+    current etag, a form with only etag and not_modified set is returned
+    instead."""
+    version_key = VERSION_PREFIX + urlsafe_game_key
+    form_key = '{}{}:{}'.format(FORM_PREFIX, name, urlsafe_game_key)
+    cached = memcache.get_multi([version_key, form_key])
+    version = cached.get(version_key)
+    if version is not None:
+        if if_none_match == etag(version):
+            metrics.add('cache_not_modified')
+            return form_class(etag=if_none_match, not_modified=True)
+        entry = cached.get(form_key)
+        if entry and entry[0] == version:
+            metrics.add('cache_hits')
+            form = protojson.decode_message(form_class, entry[1])
+            form.etag = etag(version)
+            return form
+
+    metrics.add('cache_misses')
+    form, version = build()
+    version = version or 0
+    memcache.add(version_key, version, time=CACHE_SECONDS)
+    memcache.set(form_key, (version, protojson.encode_message(form)),
+                 time=CACHE_SECONDS)
+    if if_none_match == etag(version):
+        return form_class(etag=if_none_match, not_modified=True)
+    form.etag = etag(version)
+    return form
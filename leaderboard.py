@@ -0,0 +1,301 @@
+"""leaderboard.py - Precomputed leaderboards and rank lookups.
+The top TOP_N Scores and Users are kept as sorted snapshots in memcache and
+patched as Scores are recorded and Users' career points change, so the
+leaderboard endpoints don't need to run ordered queries over every entity.
+A User's rank is answered from counts of Users per rank band (a band being
+a performance value and a range of career points), which are kept in
+sharded entities so that a lookup sums a fixed number of counts instead of
+reading every User ranked above.
+
+The band counts are recounted daily by a chain of batch tasks that tally
+the Users into a RankBandRebuild, then swap the tally into the shards
+along with whatever the shards changed by while the batches ran."""
+
+import bisect
+import logging
+import random
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+
+TOP_N = 100
+MEMCACHE_TOP_SCORES = 'LEADERBOARD_SCORES'
+MEMCACHE_TOP_USERS = 'LEADERBOARD_USERS'
+MEMCACHE_RANK_BANDS = 'RANK_BANDS'
+CAS_RETRIES = 3
+
+# Performance is career_points / games_played, which can't exceed the six
+# strikes a game starts with. Within a performance value Users are ranked
+# by career points, which are bucketed by powers of two.
+MAX_PERFORMANCE = 6
+CAREER_POINT_BUCKETS = 32
+NUM_BANDS = (MAX_PERFORMANCE + 1) * CAREER_POINT_BUCKETS
+NUM_SHARDS = 20
+REBUILD_BATCH_SIZE = 500
+REBUILD_URL = '/tasks/rebuild_rank_bands'
+
+
+class RankBandShard(ndb.Model):
+    """One shard of the number of Users in each rank band"""
+    counts = ndb.IntegerProperty(repeated=True, indexed=False)
+
+
+class RankBandRebuild(ndb.Model):
+    """The progress of one recount of the rank bands: the Users counted
+    into each band so far, and the shards' counts when it started"""
+    counts = ndb.IntegerProperty(repeated=True, indexed=False)
+    started_counts = ndb.IntegerProperty(repeated=True, indexed=False)
+    batch = ndb.IntegerProperty(default=0, indexed=False)
+    done = ndb.BooleanProperty(default=False, indexed=False)
+
+
+def _score_entry(score, user_name=None):
+    return (-score.points, score.date.toordinal(),
+            score.to_form(user_name).user_name,
+            score.won, str(score.date))
+
+
+def _user_entry(user):
+    return (-user.performance, -user.career_points, user.games_played,
+            user.name)
+
+
+def _update_snapshot(key, update):
+    """Applies update to the snapshot stored under key with compare-and-set.
+    update takes the current list of entries and returns the new list, or
+    None if the snapshot can no longer be patched and must be rebuilt. A
+    missing snapshot is left alone; it is rebuilt on the next read."""
+    client = memcache.Client()
+    for _ in range(CAS_RETRIES):
+        entries = client.gets(key)
+        if entries is None:
+            return
+        entries = update(list(entries))
+        if entries is None:
+            break
+        if client.cas(key, entries):
+            return
+    client.delete(key)
+
+
+def record_score(score):
+    """Adds a newly written Score to the top scores snapshot"""
+    entry = _score_entry(score)
+
+    def update(entries):
+        position = bisect.bisect_right([e[:2] for e in entries], entry[:2])
+        if position < TOP_N:
+            entries.insert(position, entry)
+        return entries[:TOP_N]
+    _update_snapshot(MEMCACHE_TOP_SCORES, update)
+
+
+def record_user(user, previous_band=None):
+    """Updates the top users snapshot and the rank band counts after a User
+    is created (previous_band None) or their career points change"""
+    entry = _user_entry(user)
+
+    def update(entries):
+        was_ranked = False
+        for i, e in enumerate(entries):
+            if e[3] == user.name:
+                del entries[i]
+                was_ranked = True
+                break
+        position = bisect.bisect_right([e[:3] for e in entries], entry[:3])
+        if position == len(entries) and was_ranked and \
+                len(entries) == TOP_N - 1:
+            # The user fell to the bottom of a full snapshot; someone
+            # outside the snapshot may now outrank them.
+            return None
+        entries.insert(position, entry)
+        return entries[:TOP_N]
+    _update_snapshot(MEMCACHE_TOP_USERS, update)
+
+    band = band_for(user)
+    if band != previous_band:
+        _move_between_bands(previous_band, band)
+
+
+def get_top_scores(num_results):
+    """Returns up to num_results (at most TOP_N) entries from the top scores
+    snapshot as (points, user_name, won, date) tuples"""
+    entries = memcache.get(MEMCACHE_TOP_SCORES)
+    if entries is None:
+        from models import Score, resolve_user_names
+        qu = Score.query().order(-Score.points).order(Score.date)
+        scores = qu.fetch(TOP_N)
+        names = resolve_user_names(scores)
+        entries = [_score_entry(score, names.get(score.user))
+                   for score in scores]
+        memcache.set(MEMCACHE_TOP_SCORES, entries)
+    return [(-e[0], e[2], e[3], e[4]) for e in entries[:num_results]]
+
+
+def get_top_users(num_results):
+    """Returns up to num_results (at most TOP_N) entries from the top users
+    snapshot as (name, games_played, career_points, performance) tuples"""
+    entries = memcache.get(MEMCACHE_TOP_USERS)
+    if entries is None:
+        from models import User
+        qu = User.query().\
+            order(-User.performance).\
+            order(-User.career_points).\
+            order(User.games_played)
+        entries = [_user_entry(user) for user in qu.fetch(TOP_N)]
+        memcache.set(MEMCACHE_TOP_USERS, entries)
+    return [(e[3], e[2], -e[1], -e[0]) for e in entries[:num_results]]
+
+
+def band_for(user):
+    """Returns the rank band of a User. Higher bands rank higher."""
+    performance = min(max(int(user.performance), 0), MAX_PERFORMANCE)
+    bucket = min(max(user.career_points, 0).bit_length(),
+                 CAREER_POINT_BUCKETS - 1)
+    return performance * CAREER_POINT_BUCKETS + bucket
+
+
+def _shard_keys():
+    return [ndb.Key(RankBandShard, str(i)) for i in range(NUM_SHARDS)]
+
+
+def _sum_shards(shards):
+    counts = [0] * NUM_BANDS
+    for shard in shards:
+        if shard:
+            for band, count in enumerate(shard.counts):
+                counts[band] += count
+    return counts
+
+
+@ndb.transactional
+def _apply_to_shard(key, deltas):
+    shard = key.get() or RankBandShard(key=key, counts=[0] * NUM_BANDS)
+    for band, delta in deltas.items():
+        shard.counts[band] += delta
+    shard.put()
+
+
+def _move_between_bands(old_band, new_band):
+    deltas = {new_band: 1}
+    if old_band is not None:
+        deltas[old_band] = -1
+    key = random.choice(_shard_keys())
+    _apply_to_shard(key, deltas)
+    # The cached counts are dropped rather than patched; they're rebuilt
+    # from the shards with a single multi-get on the next lookup.
+    memcache.delete(MEMCACHE_RANK_BANDS)
+
+
+@ndb.tasklet
+def get_band_counts_async():
+    """Tasklet resolving a list with the number of Users in each rank
+    band"""
+    ctx = ndb.get_context()
+    counts = yield ctx.memcache_get(MEMCACHE_RANK_BANDS)
+    if counts is None:
+        shards = yield ndb.get_multi_async(_shard_keys())
+        counts = _sum_shards(shards)
+        yield ctx.memcache_set(MEMCACHE_RANK_BANDS, counts)
+    raise ndb.Return(counts)
+
+
+def get_band_counts():
+    """Returns a list with the number of Users in each rank band"""
+    return get_band_counts_async().get_result()
+
+
+def get_rank(user, counts=None):
+    """Returns a (rank, tied, total) tuple for a User: rank is the position
+    of the best ranked User in the same band, tied the number of Users in
+    that band and total the number of ranked Users. counts may be passed in
+    by callers that have already fetched the band counts."""
+    if counts is None:
+        counts = get_band_counts()
+    band = band_for(user)
+    rank = sum(counts[band + 1:]) + 1
+    return rank, max(counts[band], 1), sum(counts)
+
+
+def start_rank_band_rebuild():
+    """Starts a recount of the Users in each rank band, used to backfill
+    the counts and to correct any drift, and returns its id"""
+    started_counts = _sum_shards(ndb.get_multi(_shard_keys(),
+                                               use_cache=False,
+                                               use_memcache=False))
+    rebuild = RankBandRebuild(id=str(RankBandRebuild.allocate_ids(1)[0]),
+                              counts=[0] * NUM_BANDS,
+                              started_counts=started_counts)
+    rebuild.put()
+    _enqueue_rebuild(rebuild.key.id(), 0)
+    return rebuild.key.id()
+
+
+def _enqueue_rebuild(run, number, cursor=None):
+    params = {'run': run, 'batch': number}
+    if cursor:
+        params['cursor'] = cursor.urlsafe()
+    # Naming the task after the run and batch makes a retried batch that
+    # already enqueued its successor a no-op.
+    try:
+        taskqueue.add(url=REBUILD_URL, params=params,
+                      name='rank-bands-{}-{}'.format(run, number))
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        pass
+
+
+@ndb.transactional
+def _add_to_rebuild(run, number, counts):
+    """Adds counts to a rebuild's tally, unless batch number was already
+    added. Returns whether it was."""
+    rebuild = RankBandRebuild.get_by_id(run)
+    if not rebuild or rebuild.done or rebuild.batch != number:
+        return False
+    rebuild.counts = [a + b for a, b in zip(rebuild.counts, counts)]
+    rebuild.batch += 1
+    rebuild.put()
+    return True
+
+
+@ndb.transactional(xg=True)
+def _swap_in_rebuild(run):
+    """Replaces the shards' counts with a rebuild's tally, adjusted by what
+    the shards changed by since it started. Returns the new counts, or None
+    if the rebuild was already swapped in."""
+    rebuild = RankBandRebuild.get_by_id(run)
+    if not rebuild or rebuild.done:
+        return None
+    keys = _shard_keys()
+    current = _sum_shards(ndb.get_multi(keys))
+    counts = [max(count + now - then, 0) for count, now, then in
+              zip(rebuild.counts, current, rebuild.started_counts)]
+    shards = [RankBandShard(key=key, counts=[0] * NUM_BANDS) for key in keys]
+    shards[0].counts = counts
+    rebuild.done = True
+    ndb.put_multi(shards + [rebuild])
+    return counts
+
+
+def rebuild_batch(run, number, cursor=None):
+    """Counts one batch of Users into rebuild run, starting at cursor (a
+    urlsafe cursor string, or None for the first batch), and enqueues the
+    next batch, or swaps the counts into the shards after the last one"""
+    from models import User
+    users, next_cursor, more = User.query().fetch_page(
+        REBUILD_BATCH_SIZE,
+        start_cursor=Cursor(urlsafe=cursor) if cursor else None)
+    counts = [0] * NUM_BANDS
+    for user in users:
+        counts[band_for(user)] += 1
+    if not _add_to_rebuild(run, number, counts):
+        return
+    if more and next_cursor:
+        _enqueue_rebuild(run, number + 1, next_cursor)
+        return
+    counts = _swap_in_rebuild(run)
+    if counts is None:
+        return
+    memcache.delete_multi([MEMCACHE_RANK_BANDS, MEMCACHE_TOP_USERS,
+                           MEMCACHE_TOP_SCORES])
+    logging.info('Rebuilt rank bands for {} users'.format(sum(counts)))
@@ -1,49 +1,211 @@
 #!/usr/bin/env python
 
 """main.py - This file contains handlers that are called by taskqueue and/or
-cronjobs."""
+cronjobs. It doesn't import the Endpoints API (api.py), so instances only
+serving these handlers don't pay for loading it."""
+import time
+_import_started = time.time()
+
+import json
 import logging
 import webapp2
-from google.appengine.api import mail, app_identity
-from api import HangmanApi
 
-from models import User, Game
+import archive
+import counters
+import export
+import leaderboard
+import metrics
+import reminders
+import stats
+import userdir
 
 
 class SendReminderEmail(webapp2.RequestHandler):
+    @metrics.instrumented('GET /crons/send_reminder')
     def get(self):
         """Send a reminder email to each User with an email about games.
-        Called every hour using a cron job"""
-        app_id = app_identity.get_application_id()
-        users = User.query(User.email is None)
-        for user in users:
-            games = Game.query(Game.user == user.key).\
-                filter(not Game.game_over).\
-                fetch()
-            if games:
-                logging.info('This is the number of games: ' + str(len(games)))
-                subject = 'Reminder - Unfinished Game!'
-                body = 'Hello {0}, you have an unfinished Hangman game!'\
-                       '\nKey(s) are:'.format(user.name)
-                for g in games:
-                    body += "\n" + str(g.key.urlsafe())
-                logging.info("BODY: " + body)
-                # This will send test emails, the arguments to send_mail are:
-                # from, to, subject, body
-                mail.send_mail('noreply@{}.appspotmail.com'.format(app_id),
-                               user.email,
-                               subject,
-                               body)
+        Called every hour using a cron job; the emails are sent by a chain
+        of batch tasks"""
+        run = reminders.start_run()
+        logging.info('Started reminder run {}'.format(run))
+
+
+class SendReminderBatch(webapp2.RequestHandler):
+    @metrics.instrumented('POST /tasks/send_reminders')
+    def post(self):
+        """Send the reminder emails for one batch of unfinished games."""
+        reminders.send_batch(self.request.get('run'),
+                             int(self.request.get('batch')),
+                             self.request.get('cursor') or None)
+        self.response.set_status(204)
 
 
 class UpdateAverageMovesRemaining(webapp2.RequestHandler):
+    @metrics.instrumented('POST /tasks/cache_average_strikes')
     def post(self):
         """Update game listing announcement in memcache."""
-        HangmanApi._cache_average_strikes()
+        counters.recount()
+        self.response.set_status(204)
+
+
+class RebuildRankBands(webapp2.RequestHandler):
+    @metrics.instrumented('GET /crons/rebuild_rank_bands')
+    def get(self):
+        """Recount the users in each leaderboard rank band. Called daily
+        using a cron job to backfill and correct drift in the counts; the
+        users are counted by a chain of batch tasks"""
+        run = leaderboard.start_rank_band_rebuild()
+        logging.info('Started rank band rebuild {}'.format(run))
+
+
+class RebuildRankBandsBatch(webapp2.RequestHandler):
+    @metrics.instrumented('POST /tasks/rebuild_rank_bands')
+    def post(self):
+        """Count one batch of users into a rank band rebuild."""
+        leaderboard.rebuild_batch(self.request.get('run'),
+                                  int(self.request.get('batch')),
+                                  self.request.get('cursor') or None)
+        self.response.set_status(204)
+
+
+class CompactGames(webapp2.RequestHandler):
+    @metrics.instrumented('GET /crons/compact_games')
+    def get(self):
+        """Archive the games that ended a while ago. Called daily using a
+        cron job; the games are archived by a chain of batch tasks"""
+        run = archive.start_compaction()
+        logging.info('Started compaction run {}'.format(run))
+
+
+class CompactGamesBatch(webapp2.RequestHandler):
+    @metrics.instrumented('POST /tasks/compact_games')
+    def post(self):
+        """Run one batch of a compaction run."""
+        archive.compact_batch(self.request.get('run'),
+                              int(self.request.get('batch')),
+                              self.request.get('cursor') or None)
+        self.response.set_status(204)
+
+
+class PurgeArchives(webapp2.RequestHandler):
+    @metrics.instrumented('GET /crons/purge_archives')
+    def get(self):
+        """Delete the expired game archive blocks. Called daily using a
+        cron job"""
+        run = archive.start_purge()
+        logging.info('Started archive purge run {}'.format(run))
+
+
+class PurgeArchivesBatch(webapp2.RequestHandler):
+    @metrics.instrumented('POST /tasks/purge_archives')
+    def post(self):
+        """Delete one batch of expired game archive blocks."""
+        archive.purge_batch(self.request.get('run'),
+                            int(self.request.get('batch')))
         self.response.set_status(204)
 
 
+class BackfillUserNames(webapp2.RequestHandler):
+    @metrics.instrumented('GET /tasks/backfill_user_names')
+    def get(self):
+        """Start adding the missing user directory entries for existing
+        Users. Visited by an admin once, when the directory is deployed."""
+        userdir.backfill_batch()
+
+    @metrics.instrumented('POST /tasks/backfill_user_names')
+    def post(self):
+        """Add the missing user directory entries for a batch of Users."""
+        userdir.backfill_batch(self.request.get('cursor') or None)
+        self.response.set_status(204)
+
+
+class BackfillUserStats(webapp2.RequestHandler):
+    @metrics.instrumented('GET /tasks/backfill_user_stats')
+    def get(self):
+        """Start recomputing every User's stats rollup from their Scores.
+        Visited by an admin once, when the rollup is deployed."""
+        stats.backfill_batch()
+
+    @metrics.instrumented('POST /tasks/backfill_user_stats')
+    def post(self):
+        """Recompute the stats rollups of a batch of Users."""
+        stats.backfill_batch(self.request.get('cursor') or None)
+        self.response.set_status(204)
+
+
+class BackfillGameEnds(webapp2.RequestHandler):
+    @metrics.instrumented('GET /tasks/backfill_game_ends')
+    def get(self):
+        """Start giving finished games from before end times were recorded
+        an end time, so they can be archived. Visited by an admin once,
+        when archiving is deployed."""
+        archive.backfill_batch()
+
+    @metrics.instrumented('POST /tasks/backfill_game_ends')
+    def post(self):
+        """Give a batch of finished games without one an end time."""
+        archive.backfill_batch(self.request.get('cursor') or None)
+        self.response.set_status(204)
+
+
+class StartExport(webapp2.RequestHandler):
+    @metrics.instrumented('GET /admin/export')
+    def get(self):
+        """Start an export of Users, Games and Scores to the 'destination'
+        of the 'sink' (file or gcs), or resume the export 'job'. The
+        'batch_size' and 'delay_seconds' between batches are optional."""
+        try:
+            if self.request.get('job'):
+                job_id = self.request.get('job')
+                export.resume_export(job_id)
+            else:
+                job_id = export.start_export(
+                    self.request.get('sink', export.FILE_SINK),
+                    self.request.get('destination'),
+                    int(self.request.get('batch_size',
+                                         export.DEFAULT_BATCH_SIZE)),
+                    int(self.request.get('delay_seconds',
+                                         export.DEFAULT_DELAY_SECONDS)))
+        except ValueError as e:
+            self.abort(400, str(e))
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps({'job': job_id}))
+
+
+class ExportBatch(webapp2.RequestHandler):
+    @metrics.instrumented('POST /tasks/export')
+    def post(self):
+        """Export one batch of an export job."""
+        export.export_batch(self.request.get('job'),
+                            int(self.request.get('batch')))
+        self.response.set_status(204)
+
+
+class MetricsReport(webapp2.RequestHandler):
+    def get(self):
+        """Show the aggregated cost of each instrumented endpoint and
+        handler, hottest first, as JSON."""
+        metrics.flush()
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(metrics.report(), indent=2))
+
+
 app = webapp2.WSGIApplication([
     ('/crons/send_reminder', SendReminderEmail),
+    ('/tasks/send_reminders', SendReminderBatch),
     ('/tasks/cache_average_strikes', UpdateAverageMovesRemaining),
+    ('/crons/rebuild_rank_bands', RebuildRankBands),
+    ('/tasks/rebuild_rank_bands', RebuildRankBandsBatch),
+    ('/crons/compact_games', CompactGames),
+    ('/tasks/compact_games', CompactGamesBatch),
+    ('/crons/purge_archives', PurgeArchives),
+    ('/tasks/purge_archives', PurgeArchivesBatch),
+    ('/tasks/backfill_user_names', BackfillUserNames),
+    ('/tasks/backfill_user_stats', BackfillUserStats),
+    ('/tasks/backfill_game_ends', BackfillGameEnds),
+    ('/admin/export', StartExport),
+    ('/tasks/export', ExportBatch),
+    ('/admin/metrics', MetricsReport),
 ], debug=True)
+
+metrics.record('import main', (time.time() - _import_started) * 1000)
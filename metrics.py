@@ -0,0 +1,251 @@
+"""metrics.py - Per-endpoint cost instrumentation. Methods wrapped with the
+instrumented decorator record their wall time, datastore gets, puts and
+queries, memcache hits and misses, response cache outcomes and rate limit
+rejections (see add) and (for a sample of calls) response size into
+in-memory histograms. Each instance periodically adds its histograms
+to shared counters in memcache, and report() aggregates those into a list
+of the hottest paths."""
+
+import functools
+import logging
+import threading
+import time
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import memcache
+from protorpc import messages, protojson
+
+FLUSH_INTERVAL = 60
+# One call in SIZE_SAMPLE_RATE has its response serialized to measure it.
+SIZE_SAMPLE_RATE = 10
+# Latency bucket upper bounds in milliseconds; the last bucket is open.
+LATENCY_BUCKETS = [2 ** i for i in range(15)]
+MEMCACHE_PREFIX = 'METRICS:'
+MEMCACHE_NAMES = MEMCACHE_PREFIX + 'NAMES'
+
+FIELDS = ('calls', 'errors', 'total_ms', 'datastore_gets', 'datastore_puts',
+          'datastore_queries', 'memcache_hits', 'memcache_misses',
+          'sampled_calls', 'sampled_bytes', 'cache_hits', 'cache_misses',
+          'cache_not_modified', 'rate_limited')
+_DATASTORE_FIELDS = {
+    'Get': 'datastore_gets',
+    'Put': 'datastore_puts',
+    'RunQuery': 'datastore_queries',
+    'Next': 'datastore_queries',
+}
+
+# When this instance first imported the module; roughly when it started.
+STARTED = time.time()
+
+_local = threading.local()
+_lock = threading.Lock()
+_histograms = {}
+_flushed_names = set()
+_last_flush = [time.time()]
+
+
+def _pre_call(service, call, request, response):
+    stats = getattr(_local, 'stats', None)
+    if stats is not None and service == 'datastore_v3':
+        field = _DATASTORE_FIELDS.get(call)
+        if field:
+            stats[field] += 1
+
+
+def _post_call(service, call, request, response):
+    stats = getattr(_local, 'stats', None)
+    if stats is not None and service == 'memcache' and call == 'Get':
+        hits = response.item_size()
+        stats['memcache_hits'] += hits
+        stats['memcache_misses'] += request.key_size() - hits
+
+apiproxy_stub_map.apiproxy.GetPreCallHooks().Append('metrics', _pre_call)
+apiproxy_stub_map.apiproxy.GetPostCallHooks().Append('metrics', _post_call)
+
+
+def add(field, value=1):
+    """Adds value to field (one of FIELDS) of the instrumented call in
+    progress on this thread, if there is one"""
+    stats = getattr(_local, 'stats', None)
+    if stats is not None:
+        stats[field] += value
+
+
+def _response_size(result, args):
+    if isinstance(result, messages.Message):
+        return len(protojson.encode_message(result))
+    response = getattr(args[0], 'response', None) if args else None
+    if response is not None:
+        return len(response.body)
+    return None
+
+
+def instrumented(name=None):
+    """Decorator recording the cost of each call of the decorated function
+    under name (the function's name by default). Apply it beneath
+    @endpoints.method, or to webapp2 handler methods."""
+    def decorator(func):
+        metric = name or func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            outer = getattr(_local, 'stats', None)
+            stats = _local.stats = dict.fromkeys(FIELDS, 0)
+            started = time.time()
+            result = None
+            try:
+                result = func(*args, **kwargs)
+                return result
+            except Exception:
+                stats['errors'] += 1
+                raise
+            finally:
+                _local.stats = outer
+                stats['calls'] = 1
+                elapsed = (time.time() - started) * 1000
+                stats['total_ms'] = int(elapsed)
+                if not stats['errors']:
+                    _sample_size(stats, result, args)
+                _record(metric, stats, elapsed)
+        return wrapper
+    return decorator
+
+
+def record(metric, elapsed):
+    """Records a one-off timing of elapsed milliseconds under metric, such
+    as how long a module took to import"""
+    stats = dict.fromkeys(FIELDS, 0)
+    stats['calls'] = 1
+    stats['total_ms'] = int(elapsed)
+    _record(metric, stats, elapsed)
+
+
+def _sample_size(stats, result, args):
+    calls = getattr(_local, 'calls', 0) + 1
+    _local.calls = calls
+    if calls % SIZE_SAMPLE_RATE == 0:
+        size = _response_size(result, args)
+        if size is not None:
+            stats['sampled_calls'] = 1
+            stats['sampled_bytes'] = size
+
+
+def _bucket(elapsed):
+    for i, bound in enumerate(LATENCY_BUCKETS):
+        if elapsed <= bound:
+            return i
+    return len(LATENCY_BUCKETS)
+
+
+def _record(metric, stats, elapsed):
+    with _lock:
+        histogram = _histograms.setdefault(metric, {})
+        for field, value in stats.items():
+            if value:
+                histogram[field] = histogram.get(field, 0) + value
+        bucket = 'bucket{}'.format(_bucket(elapsed))
+        histogram[bucket] = histogram.get(bucket, 0) + 1
+        due = time.time() - _last_flush[0] >= FLUSH_INTERVAL
+    if due:
+        flush()
+
+
+def flush():
+    """Adds this instance's histograms to the shared counters in memcache
+    and clears them"""
+    with _lock:
+        histograms = dict(_histograms)
+        _histograms.clear()
+        _last_flush[0] = time.time()
+    if not histograms:
+        return
+    offsets = {}
+    for metric, histogram in histograms.items():
+        for field, value in histogram.items():
+            offsets['{}{}:{}'.format(MEMCACHE_PREFIX, metric, field)] = value
+    memcache.offset_multi(offsets, initial_value=0)
+    new_names = set(histograms) - _flushed_names
+    if new_names:
+        _register_names(new_names)
+        _flushed_names.update(new_names)
+
+
+def _register_names(names):
+    client = memcache.Client()
+    for _ in range(3):
+        current = client.gets(MEMCACHE_NAMES)
+        if current is None:
+            if client.add(MEMCACHE_NAMES, sorted(names)):
+                return
+            continue
+        if names <= set(current):
+            return
+        if client.cas(MEMCACHE_NAMES, sorted(set(current) | names)):
+            return
+    logging.warning('Could not register metric names {}'.format(names))
+
+
+def _percentile(buckets, count, fraction):
+    """Returns the upper bound of the latency bucket holding the given
+    fraction of calls, or None for the open bucket"""
+    seen = 0
+    for i, bucket_count in enumerate(buckets):
+        seen += bucket_count
+        if seen >= fraction * count:
+            return LATENCY_BUCKETS[i] if i < len(LATENCY_BUCKETS) else None
+    return None
+
+
+def _hit_rate(hits, misses):
+    """Returns the fraction of cache lookups that were hits, or None if
+    there were none"""
+    if not hits + misses:
+        return None
+    return round(float(hits) / (hits + misses), 3)
+
+
+def report():
+    """Returns the aggregated metrics of every instrumented path, hottest
+    (most total time) first, as a list of dicts"""
+    names = memcache.get(MEMCACHE_NAMES) or []
+    bucket_fields = ['bucket{}'.format(i)
+                     for i in range(len(LATENCY_BUCKETS) + 1)]
+    keys = ['{}{}:{}'.format(MEMCACHE_PREFIX, name, field)
+            for name in names for field in FIELDS + tuple(bucket_fields)]
+    values = memcache.get_multi(keys)
+    paths = []
+    for name in names:
+        def get(field):
+            return int(values.get('{}{}:{}'.format(MEMCACHE_PREFIX, name,
+                                                   field), 0))
+        calls = get('calls')
+        if not calls:
+            continue
+        buckets = [get(field) for field in bucket_fields]
+        sampled = get('sampled_calls')
+        paths.append({
+            'name': name,
+            'calls': calls,
+            'errors': get('errors'),
+            'total_ms': get('total_ms'),
+            'mean_ms': round(float(get('total_ms')) / calls, 1),
+            'p50_ms': _percentile(buckets, calls, 0.50),
+            'p95_ms': _percentile(buckets, calls, 0.95),
+            'p99_ms': _percentile(buckets, calls, 0.99),
+            'datastore_gets': get('datastore_gets'),
+            'datastore_puts': get('datastore_puts'),
+            'datastore_queries': get('datastore_queries'),
+            'memcache_hits': get('memcache_hits'),
+            'memcache_misses': get('memcache_misses'),
+            'cache_hits': get('cache_hits'),
+            'cache_misses': get('cache_misses'),
+            'cache_not_modified': get('cache_not_modified'),
+            'cache_hit_rate': _hit_rate(get('cache_hits') +
+                                        get('cache_not_modified'),
+                                        get('cache_misses')),
+            'rate_limited': get('rate_limited'),
+            'shed_pct': round(100.0 * get('rate_limited') / calls, 1),
+            'mean_response_bytes': (round(float(get('sampled_bytes')) /
+                                          sampled) if sampled else None),
+        })
+    paths.sort(key=lambda path: path['total_ms'], reverse=True)
+    return paths
@@ -2,14 +2,74 @@
 entities used by the Game. Because these classes are also regular Python
 classes they can include methods (such as 'to_form' and 'new_game')."""
 
-import random
 import json
-from datetime import date
+from datetime import date, datetime
 from protorpc import messages
 from google.appengine.ext import ndb
 
-with open("wordlist.txt") as f:
-    wordList = f.read().splitlines()
+import counters
+import engine
+import formcache
+import leaderboard
+import stats
+import wordstore
+
+# When True, the owning User's name is copied onto each Game and Score as it
+# is created, so list endpoints can build their forms without a User lookup.
+# User names never change once created, so the copy can't go stale.
+DENORMALIZE_USER_NAMES = True
+
+HIT_MESSAGE = "The letter IS in the secret word!"
+MISS_MESSAGE = "The letter IS NOT in the secret word!"
+
+
+@ndb.tasklet
+def resolve_user_names_async(entities):
+    """Tasklet resolving a dict mapping User keys to User names for every
+    entity in entities (Games or Scores) that lacks a denormalized
+    user_name. All the distinct User keys are fetched with a single
+    multi-get."""
+    keys = list(set(e.user for e in entities if not e.user_name))
+    if not keys:
+        raise ndb.Return({})
+    users = yield ndb.get_multi_async(keys)
+    raise ndb.Return(dict((key, user.name) for key, user in
+                          zip(keys, users) if user))
+
+
+def resolve_user_names(entities):
+    """Returns the dict resolve_user_names_async resolves"""
+    return resolve_user_names_async(entities).get_result()
+
+
+@ndb.tasklet
+def scores_to_forms_async(scores):
+    """Tasklet resolving a list of ScoreForms for scores, looking up user
+    names in one batch instead of one get per Score"""
+    scores = list(scores)
+    names = yield resolve_user_names_async(scores)
+    raise ndb.Return([score.to_form(names.get(score.user))
+                      for score in scores])
+
+
+def scores_to_forms(scores):
+    """Returns the list of ScoreForms scores_to_forms_async resolves"""
+    return scores_to_forms_async(scores).get_result()
+
+
+@ndb.tasklet
+def games_to_forms_async(games, message):
+    """Tasklet resolving a list of GameForms for games, looking up user
+    names in one batch instead of one get per Game"""
+    games = list(games)
+    names = yield resolve_user_names_async(games)
+    raise ndb.Return([game.to_form(message, names.get(game.user))
+                      for game in games])
+
+
+def games_to_forms(games, message):
+    """Returns the list of GameForms games_to_forms_async resolves"""
+    return games_to_forms_async(games, message).get_result()
 
 
 class User(ndb.Model):
@@ -22,6 +82,12 @@ class User(ndb.Model):
                                        self.games_played if self.games_played >
                                        0 else 0)
 
+    def add_game(self, points):
+        """Adds a finished game worth points to the User's career.
+        performance is updated upon put()"""
+        self.games_played += 1
+        self.career_points += points
+
     def to_form(self):
         """Returns a UserForm representation of the User"""
         return UserForm(name=self.name,
@@ -33,31 +99,129 @@ class User(ndb.Model):
 class Game(ndb.Model):
     """Game object"""
     target_string = ndb.StringProperty(required=True)
-    shown_string = ndb.StringProperty(required=True)
+    # Guessed letters in the order they were guessed; guessed_mask holds the
+    # same letters as an engine mask. Games created before the mask existed
+    # don't have it stored, so it is derived from guessed_letters instead.
     guessed_letters = ndb.StringProperty(required=True, default="")
-    correct_letters = ndb.StringProperty(required=True, default="")
+    guessed_mask = ndb.IntegerProperty(indexed=False)
     strikes_remaining = ndb.IntegerProperty(required=True, default=6)
     game_over = ndb.BooleanProperty(required=True, default=False)
     user = ndb.KeyProperty(required=True, kind='User')
+    user_name = ndb.StringProperty(indexed=False)
+    pack = ndb.StringProperty(indexed=False)
+    # The move history, three characters per move: the letter guessed, '+'
+    # for a hit or '-' for a miss, and the strikes remaining after it.
+    # Games created before this existed keep their history as JSON instead.
+    moves = ndb.StringProperty(indexed=False, default='')
     history = ndb.JsonProperty(required=True, default=[])
+    # When the game ended; finished games are archived a while after.
+    ended = ndb.DateTimeProperty()
+    # Bumped on every put; identifies cached responses built from the game.
+    version = ndb.IntegerProperty(indexed=False)
+
+    def _pre_put_hook(self):
+        self.version = (self.version or 0) + 1
+
+    def _post_put_hook(self, future):
+        if not future.get_exception():
+            formcache.game_updated(self.key, self.version)
 
     @classmethod
-    def new_game(cls, user):
+    def new_game(cls, user, user_name=None, pack=None, word_length=None,
+                 difficulty=None):
         """Creates and returns a new game - strikes always 6:
-        1 head, 1 body, 2 legs, 2 arms"""
-        targString = wordList[random.randint(0, len(wordList) - 1)]
-        blankString = '_' * len(targString)
+        1 head, 1 body, 2 legs, 2 arms. The target word is drawn from the
+        given word pack (the default pack if None), optionally limited to a
+        word length and difficulty.
+        Raises:
+            ValueError: If the pack doesn't exist or has no matching word"""
+        targString = wordstore.get_store(pack).random_word(word_length,
+                                                           difficulty)
         game = Game(user=user,
                     target_string=targString,
-                    shown_string=blankString)
+                    guessed_mask=0,
+                    pack=pack)
+        if DENORMALIZE_USER_NAMES:
+            game.user_name = user_name
         game.put()
         return game
 
-    def to_form(self, message):
-        """Returns a GameForm representation of the Game"""
+    @property
+    def letter_mask(self):
+        """The engine mask of the letters guessed so far"""
+        if self.guessed_mask is None:
+            return engine.letter_mask(self.guessed_letters)
+        return self.guessed_mask
+
+    @property
+    def shown_string(self):
+        """The target string with the letters not yet guessed blanked out"""
+        return engine.shown_string(self.target_string, self.letter_mask)
+
+    def has_guessed(self, letter):
+        """Returns True if the lowercase letter has already been guessed"""
+        return self.letter_mask & engine.letter_bit(letter) != 0
+
+    def guess_letter(self, letter):
+        """Records a guess of the lowercase letter, taking a strike if it
+        misses. Returns True if the letter is in the target string."""
+        self.guessed_mask = self.letter_mask | engine.letter_bit(letter)
+        self.guessed_letters += letter
+        if engine.is_hit(self.target_string, letter):
+            return True
+        self.strikes_remaining -= 1
+        return False
+
+    def is_solved(self):
+        """Returns True if every letter of the target string was guessed"""
+        return engine.is_solved(self.target_string, self.letter_mask)
+
+    def play_guess(self, guess):
+        """Plays a guess. Returns a (message, strikes_lost) tuple, where
+        strikes_lost is None if the guess was rejected and the game left
+        unchanged. A guess that ends the game sets game_over; the caller
+        then records the end with finish()."""
+        if not engine.is_letter(guess):
+            return 'Your guess must be a single English letter!', None
+        guess = guess.lower()
+        if self.has_guessed(guess):
+            return 'You have already guessed this letter', None
+
+        strikes_lost = 0
+        if self.guess_letter(guess):
+            msg = HIT_MESSAGE
+        else:
+            strikes_lost = 1
+            msg = MISS_MESSAGE
+        self.moves += '{}{}{}'.format(guess, '-' if strikes_lost else '+',
+                                      self.strikes_remaining)
+
+        if self.is_solved():
+            self.game_over = True
+            return 'You win! ', strikes_lost
+        if self.strikes_remaining < 1:
+            self.game_over = True
+            return msg + ' Game over!', strikes_lost
+        return msg, strikes_lost
+
+    @ndb.tasklet
+    def get_user_name_async(self):
+        """Tasklet resolving the name of the User playing this Game"""
+        if self.user_name:
+            raise ndb.Return(self.user_name)
+        user = yield self.user.get_async()
+        raise ndb.Return(user.name)
+
+    def get_user_name(self):
+        """Returns the name of the User playing this Game"""
+        return self.user_name or self.user.get().name
+
+    def to_form(self, message, user_name=None):
+        """Returns a GameForm representation of the Game. user_name may be
+        passed in by callers that have already resolved it."""
         form = GameForm()
         form.urlsafe_key = self.key.urlsafe()
-        form.user_name = self.user.get().name
+        form.user_name = user_name or self.get_user_name()
         form.strikes_remaining = self.strikes_remaining
         form.shown_string = self.shown_string
         form.guessed_letters = self.guessed_letters
@@ -65,26 +229,94 @@ class Game(ndb.Model):
         form.message = message
         return form
 
+    def get_moves(self):
+        """Returns the moves made as a list of (guess, hit, strikes)
+        tuples"""
+        legacy = [(move['guess'], move['message'] == HIT_MESSAGE,
+                   move['strikes']) for move in self.history]
+        return legacy + [(self.moves[i], self.moves[i + 1] == '+',
+                          int(self.moves[i + 2]))
+                         for i in range(0, len(self.moves), 3)]
+
     def history_to_form(self):
         """Returns a GameHistoryForm representation of the Game"""
+        history = [{"guess": guess,
+                    "message": HIT_MESSAGE if hit else MISS_MESSAGE,
+                    "strikes": strikes}
+                   for guess, hit, strikes in self.get_moves()]
         return GameHistoryForm(urlsafe_key=self.key.urlsafe(),
                                game_over=self.game_over,
-                               user_name=self.user.get().name,
-                               history=json.dumps(self.history, sort_keys=True,
+                               user_name=self.get_user_name(),
+                               history=json.dumps(history, sort_keys=True,
                                                   indent=2,
                                                   separators=(',', ': '))
                                )
 
-    def end_game(self, won=False):
-        """Ends the game - if won is True, the player won. - if won is False,
-        the player lost."""
+    def moves_to_form(self, offset=0, limit=None):
+        """Returns a MoveForms representation of the moves made, starting at
+        offset and at most limit of them"""
+        moves = self.get_moves()
+        end = len(moves) if limit is None else offset + limit
+        return MoveForms(urlsafe_key=self.key.urlsafe(),
+                         game_over=self.game_over,
+                         user_name=self.get_user_name(),
+                         total=len(moves),
+                         items=[MoveForm(guess=guess, hit=hit,
+                                         strikes=strikes,
+                                         message=HIT_MESSAGE if hit
+                                         else MISS_MESSAGE)
+                                for guess, hit, strikes in
+                                moves[offset:end]])
+
+    def finish(self, won=False):
+        """Marks the game over and returns its Score, unsaved - if won is
+        True, the player won. - if won is False, the player lost."""
         self.game_over = True
-        self.put()
+        self.ended = datetime.utcnow()
         # Add the game to the score 'board'
         score = Score(user=self.user, date=date.today(),
                       won=won,
                       points=self.strikes_remaining)
-        score.put()
+        if DENORMALIZE_USER_NAMES:
+            score.user_name = self.user_name
+        return score
+
+    def record_end(self, score, strikes_lost=0):
+        """Updates the active game counters and the leaderboard once the
+        game and its Score are written. strikes_lost is the number of
+        strikes the final action took that haven't yet been taken off the
+        active counters."""
+        counters.increment(games=-1,
+                           strikes=-(self.strikes_remaining + strikes_lost))
+        leaderboard.record_score(score)
+
+    def end_game(self, won=False, forfeit=False):
+        """Ends the game, writing it, its Score and the User's stats in one
+        transaction, and returns the ended Game - if won is True, the player
+        won. - if won is False, the player lost. If forfeit is True the
+        player loses all their remaining strikes. The Game is read again
+        inside the transaction, so moves made since this copy was loaded
+        are kept, and the returned Game should be used instead of this one.
+        Raises:
+            endpoints.ForbiddenException: If the game has already ended,
+                e.g. by a concurrent move or cancel"""
+        import endpoints
+
+        def txn():
+            game = self.key.get()
+            if game.game_over:
+                raise endpoints.ForbiddenException('Game already over!')
+            strikes_lost = game.strikes_remaining if forfeit else 0
+            game.strikes_remaining -= strikes_lost
+            score = game.finish(won)
+            user_stats = stats.UserStats.key_for(game.user).get() or \
+                stats.UserStats.empty(game.user)
+            user_stats.add_score(score)
+            ndb.put_multi([game, score, user_stats])
+            return game, score, strikes_lost
+        game, score, strikes_lost = ndb.transaction(txn, xg=True)
+        game.record_end(score, strikes_lost)
+        return game
 
 
 class Score(ndb.Model):
@@ -93,31 +325,43 @@ class Score(ndb.Model):
     date = ndb.DateProperty(required=True)
     won = ndb.BooleanProperty(required=True)
     points = ndb.IntegerProperty(required=True)
+    user_name = ndb.StringProperty(indexed=False)
 
-    def to_form(self):
-        return ScoreForm(user_name=self.user.get().name, won=self.won,
+    def to_form(self, user_name=None):
+        """Returns a ScoreForm representation of the Score. user_name may be
+        passed in by callers that have already resolved it."""
+        user_name = user_name or self.user_name or self.user.get().name
+        return ScoreForm(user_name=user_name, won=self.won,
                          date=str(self.date), points=self.points)
 
 
 class GameForm(messages.Message):
-    """GameForm for outbound game state information"""
-    urlsafe_key = messages.StringField(1, required=True)
-    strikes_remaining = messages.IntegerField(2, required=True)
-    shown_string = messages.StringField(3, required=True)
-    guessed_letters = messages.StringField(4, required=True)
-    game_over = messages.BooleanField(5, required=True)
-    message = messages.StringField(6, required=True)
-    user_name = messages.StringField(7, required=True)
+    """GameForm for outbound game state information. A get_game response
+    to an If-None-Match that is still current only carries etag and
+    not_modified, so the other fields are not required."""
+    urlsafe_key = messages.StringField(1)
+    strikes_remaining = messages.IntegerField(2)
+    shown_string = messages.StringField(3)
+    guessed_letters = messages.StringField(4)
+    game_over = messages.BooleanField(5)
+    message = messages.StringField(6)
+    user_name = messages.StringField(7)
+    etag = messages.StringField(8)
+    not_modified = messages.BooleanField(9)
 
 
 class GameForms(messages.Message):
     """Return multiple GameForms"""
     items = messages.MessageField(GameForm, 1, repeated=True)
+    next_page_token = messages.StringField(2)
 
 
 class NewGameForm(messages.Message):
     """Used to create a new game"""
     user_name = messages.StringField(1, required=True)
+    word_length = messages.IntegerField(2)
+    difficulty = messages.IntegerField(3)
+    pack = messages.StringField(4)
 
 
 class MakeMoveForm(messages.Message):
@@ -125,6 +369,25 @@ class MakeMoveForm(messages.Message):
     guess = messages.StringField(1, required=True)
 
 
+class MakeMovesForm(messages.Message):
+    """Used to make several moves in an existing game"""
+    guesses = messages.StringField(1, repeated=True)
+
+
+class MoveResultForm(messages.Message):
+    """MoveResultForm for outbound information about one of several moves"""
+    guess = messages.StringField(1, required=True)
+    message = messages.StringField(2, required=True)
+    accepted = messages.BooleanField(3, required=True)
+
+
+class MoveResultForms(messages.Message):
+    """Return the result of each of several moves and the final game
+    state"""
+    results = messages.MessageField(MoveResultForm, 1, repeated=True)
+    game = messages.MessageField(GameForm, 2, required=True)
+
+
 class ScoreForm(messages.Message):
     """ScoreForm for outbound Score information"""
     user_name = messages.StringField(1, required=True)
@@ -136,6 +399,7 @@ class ScoreForm(messages.Message):
 class ScoreForms(messages.Message):
     """Return multiple ScoreForms"""
     items = messages.MessageField(ScoreForm, 1, repeated=True)
+    next_page_token = messages.StringField(2)
 
 
 class StringMessage(messages.Message):
@@ -154,11 +418,64 @@ class UserForm(messages.Message):
 class UserForms(messages.Message):
     """Return multiple UserForms"""
     items = messages.MessageField(UserForm, 1, repeated=True)
+    next_page_token = messages.StringField(2)
+
+
+class RankForm(messages.Message):
+    """RankForm for outbound User rank information"""
+    user_name = messages.StringField(1, required=True)
+    rank = messages.IntegerField(2, required=True)
+    tied = messages.IntegerField(3, required=True)
+    total_users = messages.IntegerField(4, required=True)
+    performance = messages.FloatField(5, required=True)
+
+
+class UserStatsForm(messages.Message):
+    """UserStatsForm for outbound User statistics"""
+    user_name = messages.StringField(1, required=True)
+    games_played = messages.IntegerField(2, required=True)
+    wins = messages.IntegerField(3, required=True)
+    losses = messages.IntegerField(4, required=True)
+    win_rate = messages.FloatField(5, required=True)
+    current_streak = messages.IntegerField(6, required=True)
+    best_streak = messages.IntegerField(7, required=True)
+    average_points = messages.FloatField(8, required=True)
+    points_histogram = messages.IntegerField(9, repeated=True)
+    last_played = messages.StringField(10)
+
+
+class HintForm(messages.Message):
+    """HintForm for outbound letter suggestions"""
+    urlsafe_key = messages.StringField(1, required=True)
+    letter = messages.StringField(2)
+    candidates = messages.IntegerField(3, required=True)
+    hits = messages.IntegerField(4, required=True)
+    message = messages.StringField(5, required=True)
 
 
 class GameHistoryForm(messages.Message):
-    """GameHistoryForm for outound Game History information"""
+    """GameHistoryForm for outound Game History information. Fields are
+    not required for the same reason as GameForm's."""
+    urlsafe_key = messages.StringField(1)
+    game_over = messages.BooleanField(2)
+    user_name = messages.StringField(3)
+    history = messages.StringField(4)
+    etag = messages.StringField(5)
+    not_modified = messages.BooleanField(6)
+
+
+class MoveForm(messages.Message):
+    """MoveForm for outbound information about a single move"""
+    guess = messages.StringField(1, required=True)
+    hit = messages.BooleanField(2, required=True)
+    strikes = messages.IntegerField(3, required=True)
+    message = messages.StringField(4, required=True)
+
+
+class MoveForms(messages.Message):
+    """MoveForms for outbound Game move history information"""
     urlsafe_key = messages.StringField(1, required=True)
     game_over = messages.BooleanField(2, required=True)
     user_name = messages.StringField(3, required=True)
-    history = messages.StringField(4, required=True)
+    total = messages.IntegerField(4, required=True)
+    items = messages.MessageField(MoveForm, 5, repeated=True)
@@ -0,0 +1,93 @@
+"""ratelimit.py - Per-client rate limits for the API. Each limited endpoint
+has a budget of requests per window, and every key (a user name, a game
+key, or the client's address for create_user and endpoints that have
+neither) gets a bucket holding that many tokens, refilled at the start of
+each window.
+
+Buckets are memcache counters taken with an atomic increment, so a request
+costs one memcache call and nothing else before it is admitted or turned
+away; the datastore is never touched for a rejected request. If memcache
+is unavailable requests are let through rather than refused.
+
+Rejected requests are counted with metrics (rate_limited), so
+/admin/metrics shows how much load each endpoint shed."""
+
+import functools
+import time
+from google.appengine.api import memcache
+
+import metrics
+from utils import TooManyRequestsException
+
+ENABLED = True
+MEMCACHE_PREFIX = 'RATE:'
+# Endpoint name -> (requests, seconds): each key may make that many
+# requests to the endpoint in every window of that many seconds.
+BUDGETS = {
+    'create_user': (5, 60),
+    'new_game': (20, 60),
+    'make_move': (60, 60),
+    'make_moves': (20, 60),
+    'get_hint': (30, 60),
+    'cancel_game': (10, 60),
+    'get_scores': (30, 60),
+    'get_user_scores': (30, 60),
+    'get_user_stats': (60, 60),
+    'get_user_games': (60, 60),
+    'get_high_scores': (30, 60),
+    'get_user_rankings': (30, 60),
+    'get_my_rank': (60, 60),
+    'get_game_moves': (60, 60),
+}
+
+
+def by_field(name):
+    """Returns a key function keying buckets on a field of the request"""
+    return lambda service, request: getattr(request, name)
+
+
+def by_client(service, request):
+    """Key function keying buckets on the client's address"""
+    state = service.request_state
+    return state.remote_address if state else None
+
+
+def take(name, key, now=None):
+    """Takes a token from key's bucket for endpoint name. Returns False if
+    the bucket is empty."""
+    requests, seconds = BUDGETS[name]
+    window = int(now or time.time()) // seconds
+    bucket = u'{}{}:{}:{}'.format(MEMCACHE_PREFIX, name, key, window)
+    client = memcache.Client()
+    taken = client.incr(bucket)
+    if taken is None:
+        # First request of the window: create the bucket so that it expires
+        # with the window, unless a concurrent request just did.
+        if client.add(bucket, 1, time=seconds):
+            return True
+        taken = client.incr(bucket)
+        if taken is None:
+            return True
+    return taken <= requests
+
+
+def limited(name, key):
+    """Decorator rejecting calls of the decorated endpoint method once the
+    caller's bucket for endpoint name is empty. key is called with the
+    service and the request and returns the bucket's key; calls it returns
+    None for are not limited. Apply it beneath @metrics.instrumented().
+    Raises:
+        utils.TooManyRequestsException: If the bucket is empty"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(service, request):
+            if ENABLED:
+                bucket_key = key(service, request)
+                if bucket_key is not None and not take(name, bucket_key):
+                    metrics.add('rate_limited')
+                    raise TooManyRequestsException(
+                        'Rate limit exceeded: too many {} requests, try '
+                        'again later'.format(name))
+            return func(service, request)
+        return wrapper
+    return decorator
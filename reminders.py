@@ -0,0 +1,88 @@
+"""reminders.py - Batched pipeline for the unfinished game reminder emails.
+Each batch reads a run of unfinished Games with a projection query ordered
+by User, resolves their Users with a single multi-get and mails those with
+an email address. Batches are chained through the task queue, each resuming
+from the cursor the previous batch stopped at, so no single request has to
+cover every User."""
+
+import logging
+import time
+from google.appengine.api import mail, app_identity
+from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+
+from models import Game
+
+BATCH_SIZE = 200
+BATCH_URL = '/tasks/send_reminders'
+
+
+def start_run():
+    """Enqueues the first batch of a new reminder run"""
+    run = str(int(time.time()))
+    _enqueue_batch(run, 0, None)
+    return run
+
+
+def _enqueue_batch(run, number, cursor):
+    params = {'run': run, 'batch': number}
+    if cursor:
+        params['cursor'] = cursor.urlsafe()
+    # Naming the task after the run and batch makes a retried batch that
+    # already enqueued its successor a no-op.
+    try:
+        taskqueue.add(url=BATCH_URL, params=params,
+                      name='reminders-{}-{}'.format(run, number))
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        pass
+
+
+def send_batch(run, number, cursor=None):
+    """Sends the reminders for one batch of unfinished Games, starting at
+    cursor (a urlsafe cursor string, or None for the first batch), and
+    enqueues the next batch if there is more to do"""
+    started = time.time()
+    qu = Game.query(Game.game_over == False,
+                    projection=[Game.user]).order(Game.user)
+    it = qu.iter(start_cursor=Cursor(urlsafe=cursor) if cursor else None,
+                 produce_cursors=True, batch_size=BATCH_SIZE)
+    games_by_user = {}
+    users = []
+    count = 0
+    next_cursor = None
+    for game in it:
+        # Batches only end between Users so nobody gets two emails.
+        if count >= BATCH_SIZE and game.user not in games_by_user:
+            next_cursor = it.cursor_before()
+            break
+        if game.user not in games_by_user:
+            games_by_user[game.user] = []
+            users.append(game.user)
+        games_by_user[game.user].append(game.key)
+        count += 1
+    if next_cursor:
+        _enqueue_batch(run, number + 1, next_cursor)
+
+    app_id = app_identity.get_application_id()
+    sent = 0
+    for user in ndb.get_multi(users):
+        if not user or not user.email:
+            continue
+        subject = 'Reminder - Unfinished Game!'
+        body = 'Hello {0}, you have an unfinished Hangman game!'\
+               '\nKey(s) are:'.format(user.name)
+        for key in games_by_user[user.key]:
+            body += "\n" + str(key.urlsafe())
+        # This will send test emails, the arguments to send_mail are:
+        # from, to, subject, body
+        mail.send_mail('noreply@{}.appspotmail.com'.format(app_id),
+                       user.email,
+                       subject,
+                       body)
+        sent += 1
+    logging.info('Reminder run {} batch {}: {} games, {} users, {} emails '
+                 'sent in {:.2f}s{}'.format(
+                     run, number, count, len(users), sent,
+                     time.time() - started,
+                     '' if next_cursor else ' (last batch)'))
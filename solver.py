@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+
+"""solver.py - Hint engine over a word pack. For each word length the pack's
+words are indexed into NumPy arrays: a letter mask per word, and a matrix of
+letter bits by word and position. Filtering the words that fit a shown
+string and the letters guessed so far, and counting how many of them
+contain each letter, are then a handful of vectorized array operations.
+
+The same engine rates word difficulty offline, by how many misses it takes
+to solve a word using its own hints. To rebuild a pack with those ratings:
+    python solver.py wordlist.txt wordlist.idx"""
+
+import io
+import string
+import sys
+import threading
+
+import numpy
+
+import engine
+import wordstore
+
+ASCII_LOWERCASE = frozenset(string.ascii_lowercase)
+ALPHABET_BITS = numpy.array([1 << i for i in range(26)], dtype=numpy.int32)
+
+_indexes = {}
+_lock = threading.Lock()
+
+
+class LengthIndex(object):
+    """The words of one length, as arrays"""
+
+    def __init__(self, words):
+        # Only words of plain a-z letters can be expressed as masks.
+        self.words = [word for word in words
+                      if word and set(word) <= ASCII_LOWERCASE]
+        length = len(self.words[0]) if self.words else 0
+        codes = numpy.array([[ord(c) - ord('a') for c in word]
+                             for word in self.words],
+                            dtype=numpy.int32).reshape(len(self.words),
+                                                       length)
+        # bits[i, p] is the mask bit of the letter at position p of word i.
+        self.bits = numpy.left_shift(1, codes).astype(numpy.int32)
+        self.masks = numpy.bitwise_or.reduce(self.bits, axis=1) \
+            if length else numpy.zeros(len(self.words), dtype=numpy.int32)
+
+    def candidates(self, shown, guessed_mask):
+        """Returns a boolean array selecting the words that fit shown (with
+        engine.BLANK for letters not yet revealed) given the guessed
+        letters"""
+        selected = numpy.ones(len(self.words), dtype=bool)
+        hidden = []
+        for position, letter in enumerate(shown):
+            if letter == engine.BLANK:
+                hidden.append(position)
+            else:
+                selected &= self.bits[:, position] == engine.letter_bit(
+                    letter)
+        if hidden:
+            # A guessed letter would have been revealed wherever it appears,
+            # so no hidden position can hold one.
+            hidden_mask = numpy.bitwise_or.reduce(self.bits[:, hidden],
+                                                  axis=1)
+            selected &= (hidden_mask & guessed_mask) == 0
+        return selected
+
+    def letter_counts(self, selected):
+        """Returns how many of the selected words contain each letter"""
+        masks = self.masks[selected]
+        return ((masks[:, numpy.newaxis] & ALPHABET_BITS) != 0).sum(axis=0)
+
+
+def build_index(words):
+    """Returns a dict of LengthIndexes by word length for words"""
+    by_length = {}
+    for word in words:
+        by_length.setdefault(len(word), []).append(word)
+    return dict((length, LengthIndex(group))
+                for length, group in by_length.items())
+
+
+def get_index(pack, length):
+    """Returns the LengthIndex of a pack's words of length, building it on
+    first use"""
+    key = (pack or wordstore.DEFAULT_PACK, length)
+    index = _indexes.get(key)
+    if index is None:
+        with _lock:
+            index = _indexes.get(key)
+            if index is None:
+                words = wordstore.get_store(pack).words(length)
+                index = _indexes[key] = LengthIndex(words)
+    return index
+
+
+def preload(pack=None):
+    """Builds the indexes of every word length of a pack"""
+    pack = pack or wordstore.DEFAULT_PACK
+    for length, index in build_index(
+            wordstore.get_store(pack).words()).items():
+        with _lock:
+            _indexes.setdefault((pack, length), index)
+
+
+def hint(index, shown, guessed_mask):
+    """Returns a (letter, candidates, hits) tuple: the unguessed letter found
+    in the most words that still fit shown, how many words fit, and how many
+    of those contain the letter. letter is None if no word fits, or every
+    word that fits is already solved."""
+    selected = index.candidates(shown, guessed_mask)
+    candidates = int(selected.sum())
+    if not candidates:
+        return None, 0, 0
+    counts = index.letter_counts(selected)
+    counts[(ALPHABET_BITS & guessed_mask) != 0] = -1
+    best = int(counts.argmax())
+    if counts[best] <= 0:
+        return None, candidates, 0
+    return string.ascii_lowercase[best], candidates, int(counts[best])
+
+
+def misses_to_solve(index, word):
+    """Returns the number of misses the hints take to solve word"""
+    guessed = 0
+    misses = 0
+    while not engine.is_solved(word, guessed):
+        letter = hint(index, engine.shown_string(word, guessed), guessed)[0]
+        if letter is None:
+            break
+        guessed |= engine.letter_bit(letter)
+        if not engine.is_hit(word, letter):
+            misses += 1
+    return misses
+
+
+def difficulty_rater(words):
+    """Returns a function rating each of words EASY, MEDIUM or HARD by the
+    misses the hints take to solve it"""
+    indexes = build_index(words)
+
+    def rate(word):
+        if not set(word) <= ASCII_LOWERCASE:
+            return wordstore.letter_difficulty(word)
+        misses = misses_to_solve(indexes[len(word)], word)
+        if misses <= 1:
+            return wordstore.EASY
+        if misses <= 3:
+            return wordstore.MEDIUM
+        return wordstore.HARD
+    return rate
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        sys.exit('Usage: solver.py WORDLIST PACKFILE')
+    with io.open(sys.argv[1], encoding='utf-8') as f:
+        words = sorted(set(w.strip().lower() for w in f.read().splitlines()
+                           if w.strip()))
+    wordstore.build(words, sys.argv[2], difficulty_rater(words))
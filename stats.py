@@ -0,0 +1,115 @@
+"""stats.py - Per-user statistics rollups. Each User has a UserStats entity,
+a child of the User, holding their wins, losses, win streaks, a histogram
+of the points scored per game and the date they last finished a game. It
+is updated in the same transaction that writes each finished game's Score,
+so a profile costs one key get however many games the User has played.
+
+Stats for Scores written before the rollup existed are filled in by the
+backfill (backfill_batch), which recomputes each User's stats from their
+Scores and can safely be run again to correct them."""
+
+import logging
+from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+
+STATS_ID = 'stats'
+# A game scores the strikes remaining, of which there are at most six.
+MAX_POINTS = 6
+BACKFILL_BATCH_SIZE = 100
+BACKFILL_URL = '/tasks/backfill_user_stats'
+
+
+class UserStats(ndb.Model):
+    """Statistics rollup for one User"""
+    wins = ndb.IntegerProperty(default=0, indexed=False)
+    losses = ndb.IntegerProperty(default=0, indexed=False)
+    # The number of games won in a row, up to the User's latest game.
+    current_streak = ndb.IntegerProperty(default=0, indexed=False)
+    best_streak = ndb.IntegerProperty(default=0, indexed=False)
+    # points[n] is the number of games the User scored n points in.
+    points = ndb.IntegerProperty(repeated=True, indexed=False)
+    last_played = ndb.DateProperty(indexed=False)
+
+    @classmethod
+    def key_for(cls, user_key):
+        """Returns the key of the stats of the User with user_key"""
+        return ndb.Key(cls, STATS_ID, parent=user_key)
+
+    @classmethod
+    def empty(cls, user_key):
+        """Returns new stats for a User with no finished games"""
+        return cls(key=cls.key_for(user_key), points=[0] * (MAX_POINTS + 1))
+
+    @property
+    def games_played(self):
+        return self.wins + self.losses
+
+    def add_score(self, score):
+        """Adds the result of a finished game's Score"""
+        if score.won:
+            self.wins += 1
+            self.current_streak += 1
+            self.best_streak = max(self.best_streak, self.current_streak)
+        else:
+            self.losses += 1
+            self.current_streak = 0
+        if len(self.points) <= MAX_POINTS:
+            self.points.extend([0] * (MAX_POINTS + 1 - len(self.points)))
+        self.points[min(max(score.points, 0), MAX_POINTS)] += 1
+        if self.last_played is None or score.date > self.last_played:
+            self.last_played = score.date
+
+    def to_form(self, user_name):
+        """Returns a UserStatsForm representation of the stats"""
+        from models import UserStatsForm
+        games = self.games_played
+        total_points = sum(n * count for n, count in enumerate(self.points))
+        return UserStatsForm(
+            user_name=user_name,
+            games_played=games,
+            wins=self.wins,
+            losses=self.losses,
+            win_rate=float(self.wins) / games if games else 0.0,
+            current_streak=self.current_streak,
+            best_streak=self.best_streak,
+            average_points=float(total_points) / games if games else 0.0,
+            points_histogram=list(self.points),
+            last_played=str(self.last_played) if self.last_played else None)
+
+
+@ndb.tasklet
+def get_stats_async(user_key):
+    """Tasklet resolving the stats of the User with user_key (empty stats if
+    the User hasn't finished a game)"""
+    stats = yield UserStats.key_for(user_key).get_async()
+    raise ndb.Return(stats or UserStats.empty(user_key))
+
+
+@ndb.tasklet
+def _recompute_async(user_key):
+    from models import Score
+    stats = UserStats.empty(user_key)
+    # Scores only record the day they were made, so games finished on the
+    # same day may be counted towards streaks in any order.
+    scores = yield Score.query(Score.user == user_key).\
+        order(Score.date).fetch_async()
+    for score in scores:
+        stats.add_score(score)
+    raise ndb.Return(stats)
+
+
+def backfill_batch(cursor=None):
+    """Recomputes the stats of one batch of Users from their Scores,
+    starting at cursor (a urlsafe cursor string, or None for the first
+    batch), and enqueues the next batch if there is more to do"""
+    from models import User
+    keys, next_cursor, more = User.query().fetch_page(
+        BACKFILL_BATCH_SIZE, keys_only=True,
+        start_cursor=Cursor(urlsafe=cursor) if cursor else None)
+    futures = [_recompute_async(key) for key in keys]
+    ndb.put_multi([future.get_result() for future in futures])
+    logging.info('Backfilled stats for {} users'.format(len(keys)))
+    if more and next_cursor:
+        taskqueue.add(url=BACKFILL_URL,
+                      params={'cursor': next_cursor.urlsafe()})
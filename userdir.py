@@ -0,0 +1,115 @@
+"""userdir.py - The user directory, which resolves User names to Users.
+Every User name has a UserName entity keyed by the name itself that points
+to the User's key, so looking a User up by name is a strongly consistent
+key get (usually answered from memcache) instead of a query, and creating
+a User can check for a duplicate name inside a transaction. User names
+never change and Users are never deleted, so a name's cached key never
+goes stale and the cache is never invalidated.
+
+Users created before the directory existed are found with a name query
+until the backfill (backfill_batch) has been run; set LEGACY_LOOKUP to
+False once it has."""
+
+import logging
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+
+from models import User
+
+LEGACY_LOOKUP = True
+MEMCACHE_PREFIX = 'USER_KEY:'
+BACKFILL_BATCH_SIZE = 500
+BACKFILL_URL = '/tasks/backfill_user_names'
+
+
+class UserName(ndb.Model):
+    """Maps a User name (the key id) to the User's key"""
+    user = ndb.KeyProperty(required=True, kind='User', indexed=False)
+
+
+@ndb.tasklet
+def get_user_key_async(name):
+    """Tasklet resolving the key of the User with name, or None if there is
+    none"""
+    ctx = ndb.get_context()
+    urlsafe = yield ctx.memcache_get(MEMCACHE_PREFIX + name)
+    if urlsafe:
+        raise ndb.Return(ndb.Key(urlsafe=urlsafe))
+    entry = yield UserName.get_by_id_async(name)
+    if entry:
+        key = entry.user
+    elif LEGACY_LOOKUP:
+        key = yield User.query(User.name == name).get_async(keys_only=True)
+        if key:
+            yield UserName(id=name, user=key).put_async()
+    else:
+        key = None
+    if key:
+        yield ctx.memcache_set(MEMCACHE_PREFIX + name, key.urlsafe())
+    raise ndb.Return(key)
+
+
+def get_user_key(name):
+    """Returns the key of the User with name, or None if there is none"""
+    return get_user_key_async(name).get_result()
+
+
+@ndb.tasklet
+def get_user_async(name):
+    """Tasklet resolving the User with name, or None if there is none"""
+    key = yield get_user_key_async(name)
+    if not key:
+        raise ndb.Return(None)
+    user = yield key.get_async()
+    raise ndb.Return(user)
+
+
+def get_user(name):
+    """Returns the User with name, or None if there is none"""
+    return get_user_async(name).get_result()
+
+
+def create_user(name, email=None):
+    """Creates and returns a User with name, or returns None if the name is
+    already taken"""
+    if LEGACY_LOOKUP and User.query(User.name == name).get(keys_only=True):
+        return None
+    user = _create_user(name, email)
+    if user:
+        memcache.set(MEMCACHE_PREFIX + name, user.key.urlsafe())
+    return user
+
+
+@ndb.transactional(xg=True)
+def _create_user(name, email):
+    if UserName.get_by_id(name):
+        return None
+    user = User(name=name, email=email)
+    user.put()
+    UserName(id=name, user=user.key).put()
+    return user
+
+
+def backfill_batch(cursor=None):
+    """Adds the missing UserName entities for one batch of Users, starting
+    at cursor (a urlsafe cursor string, or None for the first batch), and
+    enqueues the next batch if there is more to do"""
+    users, next_cursor, more = User.query().fetch_page(
+        BACKFILL_BATCH_SIZE,
+        start_cursor=Cursor(urlsafe=cursor) if cursor else None)
+    entries = ndb.get_multi([ndb.Key(UserName, user.name) for user in users])
+    missing = []
+    for user, entry in zip(users, entries):
+        if not entry:
+            missing.append(UserName(id=user.name, user=user.key))
+        elif entry.user != user.key:
+            logging.warning('Duplicate user name {!r}: {} and {}'.format(
+                user.name, entry.user, user.key))
+    ndb.put_multi(missing)
+    logging.info('Backfilled {} of {} user names'.format(len(missing),
+                                                         len(users)))
+    if more and next_cursor:
+        taskqueue.add(url=BACKFILL_URL,
+                      params={'cursor': next_cursor.urlsafe()})
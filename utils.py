@@ -1,9 +1,54 @@
 """utils.py - File for collecting general utility functions."""
 
+import contextlib
 import logging
+import os
+import threading
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import datastore_errors
+from google.appengine.datastore.datastore_query import Cursor
 from google.appengine.ext import ndb
 import endpoints
 
+# Upper bound on the number of results returned by any list endpoint.
+MAX_PAGE_SIZE = 100
+# Prefix of page tokens that continue after a number of results served from
+# elsewhere (e.g. a precomputed leaderboard) rather than from a cursor. A
+# urlsafe cursor never contains a colon.
+OFFSET_TOKEN_PREFIX = 'offset:'
+
+
+class TooManyRequestsException(endpoints.ForbiddenException):
+    """Raised when a client has used up its rate limit budget. Endpoints
+    turns a 429 into a 404, so this is a 403 that clients tell apart from
+    other refusals by its message."""
+
+
+def get_key_by_urlsafe(urlsafe, model):
+    """Returns the ndb.Key that the urlsafe key string represents, without
+        fetching the entity. Checks that the key is of the correct kind.
+    Args:
+        urlsafe: A urlsafe key string
+        model: The expected entity kind
+    Returns:
+        The ndb.Key
+    Raises:
+        endpoints.BadRequestException: If the key string is malformed
+        ValueError: If the key is of the incorrect kind"""
+    try:
+        key = ndb.Key(urlsafe=urlsafe)
+    except TypeError:
+        raise endpoints.BadRequestException('Invalid Key')
+    except Exception, e:
+        if e.__class__.__name__ == 'ProtocolBufferDecodeError':
+            raise endpoints.BadRequestException('Invalid Key')
+        else:
+            raise
+    if key.kind() != model._get_kind():
+        raise ValueError('Incorrect Kind')
+    return key
+
+
 def get_by_urlsafe(urlsafe, model):
     """Returns an ndb.Model entity that the urlsafe key points to. Checks
         that the type of entity returned is of the correct kind. Raises an
@@ -33,3 +78,108 @@ def get_by_urlsafe(urlsafe, model):
     if not isinstance(entity, model):
         raise ValueError('Incorrect Kind')
     return entity
+
+
+@ndb.tasklet
+def fetch_page_async(query, page_size=None, page_token=None):
+    """Tasklet fetching one page of results from a query. The page size is
+        capped at MAX_PAGE_SIZE so the memory used by a request stays
+        bounded however large the underlying table grows.
+    Args:
+        query: The ndb.Query to fetch from
+        page_size: The requested number of results (optional)
+        page_token: An opaque token returned by a previous call, or by
+            offset_page_token (optional)
+    Returns:
+        A (results, next_page_token) tuple. next_page_token is None when
+        there are no more results.
+    Raises:
+        endpoints.BadRequestException: If the page size is below 1 or the
+            page token is invalid"""
+    if page_size is not None and page_size < 1:
+        raise endpoints.BadRequestException('Page size must be at least 1')
+    if not page_size or page_size > MAX_PAGE_SIZE:
+        page_size = MAX_PAGE_SIZE
+    try:
+        if page_token and page_token.startswith(OFFSET_TOKEN_PREFIX):
+            offset = int(page_token[len(OFFSET_TOKEN_PREFIX):])
+            if not 0 <= offset <= MAX_PAGE_SIZE:
+                raise ValueError(offset)
+            results, next_cursor, more = yield query.fetch_page_async(
+                page_size, offset=offset)
+        else:
+            cursor = Cursor(urlsafe=page_token) if page_token else None
+            results, next_cursor, more = yield query.fetch_page_async(
+                page_size, start_cursor=cursor)
+    except (ValueError, datastore_errors.BadValueError,
+            datastore_errors.BadRequestError):
+        raise endpoints.BadRequestException('Invalid page token')
+    if more and next_cursor:
+        raise ndb.Return((results, next_cursor.urlsafe()))
+    raise ndb.Return((results, None))
+
+
+def offset_page_token(offset):
+    """Returns a page token for fetch_page_async continuing after the first
+        offset results of a query, for pages that were not fetched with
+        it"""
+    return '{}{}'.format(OFFSET_TOKEN_PREFIX, offset)
+
+
+def fetch_page(query, page_size=None, page_token=None):
+    """Returns the (results, next_page_token) tuple fetch_page_async
+        resolves"""
+    return fetch_page_async(query, page_size, page_token).get_result()
+
+
+_rpc_counts = threading.local()
+
+
+def _count_rpc(service, call, request, response):
+    counts = getattr(_rpc_counts, 'counts', None)
+    if counts is not None:
+        counts[service] = counts.get(service, 0) + 1
+
+apiproxy_stub_map.apiproxy.GetPreCallHooks().Append('rpc_counter',
+                                                    _count_rpc)
+
+
+@contextlib.contextmanager
+def count_rpcs():
+    """Counts the API RPCs made on this thread within the block. Blocks may
+        be nested; an outer block's counts include its inner blocks'.
+    Yields:
+        A dict of the RPC counts so far, by API service name (e.g.
+        'datastore_v3', 'memcache')"""
+    outer = getattr(_rpc_counts, 'counts', None)
+    counts = _rpc_counts.counts = {}
+    try:
+        yield counts
+    finally:
+        _rpc_counts.counts = outer
+        if outer is not None:
+            for key, count in counts.items():
+                outer[key] = outer.get(key, 0) + count
+
+
+@contextlib.contextmanager
+def rpc_budget(name, budget, service='datastore_v3'):
+    """Counts the RPCs made to an API service on this thread within the
+        block and checks that there were no more than budget of them. Going
+        over budget is an AssertionError on the development server, and is
+        logged as an error in production.
+    Args:
+        name: A name for the block, used in the error message
+        budget: The maximum number of RPCs allowed
+        service: The API service to count calls to
+    Yields:
+        A dict of the RPC counts so far, by service"""
+    with count_rpcs() as counts:
+        yield counts
+    used = counts.get(service, 0)
+    if used > budget:
+        error = '{} made {} {} RPCs, over its budget of {}'.format(
+            name, used, service, budget)
+        if os.environ.get('SERVER_SOFTWARE', '').startswith('Development'):
+            raise AssertionError(error)
+        logging.error(error)
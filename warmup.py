@@ -0,0 +1,63 @@
+"""warmup.py - Handler for the warmup requests App Engine sends a new
+instance before routing traffic to it. It loads the Endpoints API, maps the
+word packs and builds their hint indexes, and fills the memcache entries
+the leaderboard and average strikes endpoints read, so that the first
+player requests an instance serves don't pay for any of it.
+
+How long the instance took to become ready (counted from when metrics was
+first imported) and how long each step took are recorded with metrics, as
+are the import times of each entry module, so cold start regressions show
+in /admin/metrics."""
+
+import time
+_import_started = time.time()
+
+import logging
+import webapp2
+
+import metrics
+
+
+class Warmup(webapp2.RequestHandler):
+    @metrics.instrumented('GET /_ah/warmup')
+    def get(self):
+        """Prepare a new instance for traffic."""
+        started = time.time()
+        # Importing the API module builds the Endpoints app and imports
+        # everything it uses.
+        import api  # noqa
+        import counters
+        import leaderboard
+        import solver
+        import wordstore
+        steps = [('import api', time.time())]
+
+        for pack in wordstore.PACKS:
+            solver.preload(pack)
+        steps.append(('word packs', time.time()))
+
+        leaderboard.get_top_scores(leaderboard.TOP_N)
+        leaderboard.get_top_users(leaderboard.TOP_N)
+        leaderboard.get_band_counts()
+        counters.get_totals()
+        steps.append(('memcache', time.time()))
+
+        durations = []
+        previous = started
+        for step, finished in steps:
+            durations.append((step, (finished - previous) * 1000))
+            previous = finished
+        for step, elapsed in durations:
+            metrics.record('warmup ' + step, elapsed)
+        ready = (time.time() - metrics.STARTED) * 1000
+        metrics.record('instance startup', ready)
+        logging.info('Instance ready {:.0f}ms after start ({})'.format(
+            ready, ', '.join('{} {:.0f}ms'.format(step, elapsed)
+                             for step, elapsed in durations)))
+
+
+app = webapp2.WSGIApplication([
+    ('/_ah/warmup', Warmup),
+], debug=True)
+
+metrics.record('import warmup', (time.time() - _import_started) * 1000)
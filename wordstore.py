@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+
+"""wordstore.py - Indexed word packs that new games draw their target words
+from. A pack is built offline from a plain word list into a compact file:
+
+    header   magic, version, word count, bucket count
+    buckets  (length, difficulty, first word, word count) per bucket
+    offsets  word count + 1 offsets into the blob
+    blob     every word, packed end to end
+
+Words are sorted by length, then difficulty, so every bucket (and every
+length) is a contiguous run of word numbers and a word matching given
+constraints can be drawn in O(1). Pack files are memory-mapped on first use
+where mmap is available, and read with positional reads otherwise, so the
+word list itself is never held in memory.
+
+To rebuild a pack after editing its word list:
+    python wordstore.py wordlist.txt wordlist.idx
+or, to rate difficulty with the hint solver rather than by letters:
+    python solver.py wordlist.txt wordlist.idx"""
+
+import io
+import logging
+import os
+import random
+import string
+import struct
+import sys
+import threading
+
+try:
+    import mmap
+except ImportError:
+    mmap = None
+
+MAGIC = b'HMWS'
+VERSION = 1
+HEADER = struct.Struct('<4sIII')
+BUCKET = struct.Struct('<HHII')
+OFFSET = struct.Struct('<I')
+
+EASY, MEDIUM, HARD = 1, 2, 3
+DIFFICULTIES = (EASY, MEDIUM, HARD)
+
+DEFAULT_PACK = 'en'
+PACK_DIR = os.path.dirname(os.path.abspath(__file__))
+# Pack name -> index file, relative to PACK_DIR.
+PACKS = {
+    DEFAULT_PACK: 'wordlist.idx',
+}
+
+# The twelve most common letters in English text. Words made only of these
+# are the easiest to guess.
+COMMON_LETTERS = frozenset('etaoinshrdlu')
+
+
+def letter_difficulty(word):
+    """Rates a word EASY, MEDIUM or HARD by how many of its distinct letters
+    are uncommon"""
+    uncommon = len(set(word) - COMMON_LETTERS)
+    if uncommon == 0:
+        return EASY
+    if uncommon == 1:
+        return MEDIUM
+    return HARD
+
+
+def is_playable(word):
+    """Returns True if word is made only of the letters a-z, which are the
+    only guesses the move engine accepts"""
+    return bool(word) and all(letter in string.ascii_lowercase
+                              for letter in word)
+
+
+def build(words, path, difficulty=letter_difficulty):
+    """Writes the pack file for words to path. difficulty rates each word
+    EASY, MEDIUM or HARD. Words with anything but the letters a-z (spaces,
+    hyphens, accented letters) couldn't be won, so they are left out."""
+    words = set(w.strip().lower() for w in words if w.strip())
+    skipped = [w for w in words if not is_playable(w)]
+    if skipped:
+        logging.warning('Skipped {} words that are not all a-z, e.g. '
+                        '{!r}'.format(len(skipped), sorted(skipped)[0]))
+    words = sorted(words - set(skipped))
+    rated = sorted((len(w), difficulty(w), w) for w in words)
+    buckets = []
+    for i, (length, rating, _) in enumerate(rated):
+        if buckets and buckets[-1][:2] == [length, rating]:
+            buckets[-1][3] += 1
+        else:
+            buckets.append([length, rating, i, 1])
+    blob = b''.join(w.encode('utf-8') for _, _, w in rated)
+    offsets = [0]
+    for _, _, w in rated:
+        offsets.append(offsets[-1] + len(w.encode('utf-8')))
+    with open(path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, len(rated), len(buckets)))
+        for bucket in buckets:
+            f.write(BUCKET.pack(*bucket))
+        f.write(struct.pack('<{}I'.format(len(offsets)), *offsets))
+        f.write(blob)
+
+
+class WordStore(object):
+    """Read access to a single pack file. The file is opened lazily, on the
+    first draw."""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._data = None
+        self._file = None
+
+    def _open(self):
+        if self._data is not None or self._file is not None:
+            return
+        with self._lock:
+            if self._data is not None or self._file is not None:
+                return
+            f = open(self.path, 'rb')
+            magic, version, count, num_buckets = HEADER.unpack(
+                f.read(HEADER.size))
+            if magic != MAGIC or version != VERSION:
+                raise ValueError('{} is not a word pack'.format(self.path))
+            self.count = count
+            self.buckets = {}
+            self.lengths = {}
+            for _ in range(num_buckets):
+                length, rating, first, size = BUCKET.unpack(
+                    f.read(BUCKET.size))
+                self.buckets[(length, rating)] = (first, size)
+                start, total = self.lengths.get(length, (first, 0))
+                self.lengths[length] = (start, total + size)
+            self._offsets = HEADER.size + num_buckets * BUCKET.size
+            self._blob = self._offsets + (count + 1) * OFFSET.size
+            if mmap is not None:
+                self._data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                f.close()
+            else:
+                self._file = f
+
+    def _read(self, position, size):
+        if self._data is not None:
+            return self._data[position:position + size]
+        with self._lock:
+            self._file.seek(position)
+            return self._file.read(size)
+
+    def word(self, number):
+        """Returns word number (0 based) of the pack"""
+        self._open()
+        start, end = struct.unpack(
+            '<II', self._read(self._offsets + number * OFFSET.size,
+                              2 * OFFSET.size))
+        return self._read(self._blob + start, end - start).decode('utf-8')
+
+    def words(self, length=None):
+        """Returns a list of the pack's words with length (every word if
+        None)"""
+        self._open()
+        first, size = (self.lengths.get(length, (0, 0))
+                       if length is not None else (0, self.count))
+        return [self.word(number) for number in range(first, first + size)]
+
+    def random_word(self, length=None, difficulty=None):
+        """Returns a random word with the given length and difficulty (either
+        of which may be None for any).
+        Raises:
+            ValueError: If no word in the pack matches"""
+        self._open()
+        if length is not None and difficulty is not None:
+            ranges = [self.buckets.get((length, difficulty), (0, 0))]
+        elif length is not None:
+            ranges = [self.lengths.get(length, (0, 0))]
+        elif difficulty is not None:
+            ranges = [r for (_, d), r in self.buckets.items()
+                      if d == difficulty]
+        else:
+            ranges = [(0, self.count)]
+        total = sum(size for _, size in ranges)
+        if not total:
+            raise ValueError('No word matches those constraints')
+        number = random.randint(0, total - 1)
+        for first, size in ranges:
+            if number < size:
+                return self.word(first + number)
+            number -= size
+
+
+_stores = {}
+
+
+def get_store(pack=None):
+    """Returns the WordStore for a pack (the default pack if None).
+    Raises:
+        ValueError: If there is no such pack"""
+    pack = pack or DEFAULT_PACK
+    store = _stores.get(pack)
+    if store is None:
+        if pack not in PACKS:
+            raise ValueError('Unknown word pack: {}'.format(pack))
+        store = _stores.setdefault(
+            pack, WordStore(os.path.join(PACK_DIR, PACKS[pack])))
+    return store
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        sys.exit('Usage: wordstore.py WORDLIST PACKFILE')
+    with io.open(sys.argv[1], encoding='utf-8') as f:
+        build(f.read().splitlines(), sys.argv[2])